@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# Copyright © 2023 Dell Inc. or its subsidiaries. All Rights Reserved.
+
+"""Measure how the operator's handlers scale with the size of the fleet.
+
+The real kopf handlers of `operator/op.py` are driven against an in-process
+fake API server (see `fakeapi.py`), so no cluster is needed. Every fleet size
+runs in a fresh process, so that peak RSS is measured per size. Each DevEnv
+goes through the following events, all DevEnvs of a phase being dispatched
+concurrently, up to `--workers` at a time:
+
+- create: `create_update_dev_env`
+- mount: `update_mounts` after enabling the mounts
+- resync: `update_mounts` again, without any change
+- delete: `cleanup_mounts`
+
+Example:
+
+    python benchmarks/bench.py --devenvs 10 100 1000 2000 --mounts 2 --matches 3
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "operator"))
+
+import fakeapi  # NOQA: E402
+import kopf  # NOQA: E402
+import kubeapi  # NOQA: E402
+import kubernetes  # NOQA: E402
+import op  # NOQA: E402
+
+NAMESPACE = "bench"
+PHASES = ("create", "mount", "resync", "delete")
+
+_owner = contextvars.ContextVar("owner")
+_adopt = kopf.adopt
+
+
+def adopt(objs, owner=None, **kwargs):
+    # Outside of kopf there's no handler context to guess the owner from.
+    return _adopt(objs, owner=owner or _owner.get(), **kwargs)
+
+
+kopf.adopt = adopt
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(
+        description="Benchmark the operator against a fake API server.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    argparser.add_argument(
+        "-n",
+        "--devenvs",
+        type=int,
+        nargs="+",
+        default=[10, 100, 500, 2000],
+        help="Fleet sizes, in number of DevEnvs.",
+    )
+    argparser.add_argument(
+        "-m", "--mounts", type=int, default=1, help="Mounts per DevEnv."
+    )
+    argparser.add_argument(
+        "-k",
+        "--matches",
+        type=int,
+        default=1,
+        help="Deployments matched by each mount's label selector.",
+    )
+    argparser.add_argument("--mode", choices=("modify", "clone"), default="modify")
+    argparser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=64,
+        help="Maximum number of handlers running at the same time.",
+    )
+    argparser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Milliseconds added to every API request.",
+    )
+    argparser.add_argument(
+        "--qps",
+        type=float,
+        default=0,
+        help="Rate limit of the operator's API requests, 0 disables it.",
+    )
+    argparser.add_argument(
+        "--json", action="store_true", help="Print results as JSON lines."
+    )
+    argparser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return argparser.parse_args()
+
+
+class Store:
+    """Emulates a store of a kopf index: a sized iterable of values."""
+
+    def __init__(self):
+        self.values = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(list(self.values.values()))
+
+
+class Index(dict):
+    """Emulates the `workloads` kopf index, kept up to date on every write."""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.keys_of = {}
+
+    def on_change(self, path: str, obj: dict | None) -> None:
+        if "/deployments/" not in path:
+            return
+        with self.lock:
+            for key in self.keys_of.pop(path, ()):
+                self[key].values.pop(path, None)
+            if obj is None:
+                return
+            obj = {"kind": "Deployment", **obj}
+            entries = op.workloads(namespace=NAMESPACE, body=obj)
+            for key, manifest in entries.items():
+                self.setdefault(key, Store()).values[path] = manifest
+            self.keys_of[path] = list(entries)
+
+
+def devenv(index: int, args) -> dict:
+    name = f"devenv-{index}"
+    mounts = [
+        {
+            "kind": "deployment",
+            "labels": {"app": f"app-{index}-{mount}"},
+            "mountPath": "/app",
+            "mounted": True,
+            "entrypoints": {"app": "python -m app --reload"},
+        }
+        for mount in range(args.mounts)
+    ]
+    spec = {
+        "mode": args.mode,
+        "port": 8080,
+        "image": "devenv:latest",
+        "baseDomain": "devenv.example.com",
+        "authorizedKeys": ["ssh-ed25519 AAAA bench"],
+        "pvcSize": "8Gi",
+        "storageClass": "efs",
+        "accessMode": "ReadWriteMany",
+        "mounts": mounts,
+        "excludedPaths": [".git"],
+        "reloadSignal": "HUP",
+        "reloadCmd": "",
+        "postMountPodCmd": "",
+        "mountsEnabled": False,
+    }
+    return {
+        "apiVersion": "dell.com/v1",
+        "kind": "DevEnv",
+        "metadata": {"name": name, "namespace": NAMESPACE, "uid": f"uid-{name}"},
+        "spec": spec,
+    }
+
+
+def deployment(name: str, app: str) -> dict:
+    labels = {"app": app, "release": "bench"}
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {
+            "name": name,
+            "namespace": NAMESPACE,
+            "labels": labels,
+            "annotations": {"deployment.kubernetes.io/revision": "1"},
+            "generation": 1,
+        },
+        "spec": {
+            "replicas": 2,
+            "selector": {"matchLabels": {"app": app}},
+            "template": {
+                "metadata": {"labels": dict(labels)},
+                "spec": {
+                    "volumes": [],
+                    "containers": [
+                        {"name": "app", "image": "app:latest", "ports": [{"port": 80}]}
+                    ],
+                },
+            },
+        },
+        "status": {
+            "observedGeneration": 1,
+            "replicas": 2,
+            "updatedReplicas": 2,
+            "readyReplicas": 2,
+        },
+    }
+
+
+def seed(server: fakeapi.FakeApiServer, devenvs: list[dict], args) -> None:
+    for body in devenvs:
+        for mount in body["spec"]["mounts"]:
+            app = mount["labels"]["app"]
+            for match in range(args.matches):
+                name = f"{app}-{match}"
+                path = kubeapi.resource_path(NAMESPACE, "deployment", name)
+                server.put(path, deployment(name, app))
+
+
+def percentile(values: list[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def run_phase(handler, devenvs, index, logger, workers) -> dict:
+    semaphore = asyncio.Semaphore(workers)
+    latencies, errors = [], 0
+
+    async def dispatch(body):
+        nonlocal errors
+        kwargs = {
+            "name": body["metadata"]["name"],
+            "namespace": NAMESPACE,
+            "spec": body["spec"],
+            "body": body,
+            "meta": body["metadata"],
+            "status": body.get("status", {}),
+            "logger": logger,
+            "pools": {},
+            "patch": kopf.Patch(),
+            "retry": 0,
+        }
+        async with semaphore:
+            _owner.set(body)
+            started = time.perf_counter()
+            try:
+                if asyncio.iscoroutinefunction(handler):
+                    await handler(workloads=index, **kwargs)
+                else:
+                    # Like kopf, run sync handlers in a worker thread.
+                    await asyncio.to_thread(handler, **kwargs)
+            except Exception:
+                errors += 1
+                logger.exception("%s failed", kwargs["name"])
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*map(dispatch, devenvs))
+    elapsed = time.perf_counter() - started
+    return {
+        "events": len(devenvs),
+        "errors": errors,
+        "seconds": elapsed,
+        "events_per_sec": len(devenvs) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+async def run(args) -> list[dict]:
+    (size,) = args.devenvs
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger("bench")
+    index = Index()
+    server = fakeapi.FakeApiServer(
+        latency=args.latency / 1000, on_change=index.on_change
+    )
+    server.start()
+    configuration = kubernetes.client.Configuration()
+    configuration.host = server.url
+    kubeapi._client = kubeapi.Client(configuration)
+
+    devenvs = [devenv(i, args) for i in range(size)]
+    seed(server, devenvs, args)
+    handlers = {
+        "create": op.create_update_dev_env,
+        "mount": op.update_mounts,
+        "resync": op.update_mounts,
+        "delete": op.cleanup_mounts,
+    }
+    results = []
+    for phase in PHASES:
+        if phase == "mount":
+            for body in devenvs:
+                body["spec"]["mountsEnabled"] = True
+        server.reset_calls()
+        result = await run_phase(handlers[phase], devenvs, index, logger, args.workers)
+        result["api_calls_per_event"] = sum(server.calls.values()) / size
+        results.append({"devenvs": size, "phase": phase, **result})
+    server.stop()
+
+    # ru_maxrss is in KiB on Linux. It includes the fake API server.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    for result in results:
+        result["peak_rss_mb"] = peak_rss
+    return results
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        for result in asyncio.run(run(args)):
+            print(json.dumps(result))
+        return
+
+    if not args.json:
+        print(
+            f"{'devenvs':>8} {'phase':<7} {'events/s':>9} {'p50 ms':>8} "
+            f"{'p99 ms':>8} {'calls/ev':>8} {'errors':>6} {'rss MB':>7}"
+        )
+    for size in args.devenvs:
+        cmd = [sys.executable, __file__, "--child", "--devenvs", str(size)]
+        for flag in ("mounts", "matches", "mode", "workers", "latency"):
+            cmd += [f"--{flag}", str(getattr(args, flag))]
+        env = {**os.environ, "DEVENV_API_QPS": str(args.qps)}
+        output = subprocess.run(cmd, stdout=subprocess.PIPE, env=env, check=True).stdout
+        for line in output.decode().splitlines():
+            if args.json:
+                print(line)
+                continue
+            result = json.loads(line)
+            print(
+                f"{result['devenvs']:>8} {result['phase']:<7} "
+                f"{result['events_per_sec']:>9.1f} {result['p50_ms']:>8.1f} "
+                f"{result['p99_ms']:>8.1f} {result['api_calls_per_event']:>8.1f} "
+                f"{result['errors']:>6} {result['peak_rss_mb']:>7.1f}"
+            )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+# Copyright © 2023 Dell Inc. or its subsidiaries. All Rights Reserved.
+
+"""In-process stand-in for the Kubernetes API server.
+
+Only what the operator uses is implemented: get, list by label selector,
+server-side apply, merge patch (with optimistic locking), create and delete
+of namespaced objects.
+Objects are kept in memory, keyed by their URL path, and every request is
+recorded so that benchmarks can count API calls.
+
+Workload controllers are emulated too: a change to the spec of a Deployment
+or StatefulSet bumps its generation and is rolled out instantly.
+"""
+
+import collections
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0, on_change=None):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.latency = latency
+        self.on_change = on_change
+        self.objects = {}
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.resource_version = 0
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def put(self, path: str, obj: dict) -> dict:
+        """Store `obj` at `path`, as if it was written through the API."""
+        with self.lock:
+            self.resource_version += 1
+            metadata = obj.setdefault("metadata", {})
+            metadata["resourceVersion"] = str(self.resource_version)
+            metadata.setdefault("uid", f"uid-{self.resource_version}")
+            metadata.setdefault(
+                "creationTimestamp", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+            )
+            self.objects[path] = obj
+        if self.on_change:
+            self.on_change(path, obj)
+        return obj
+
+    def remove(self, path: str) -> dict | None:
+        with self.lock:
+            obj = self.objects.pop(path, None)
+        if obj is not None and self.on_change:
+            self.on_change(path, None)
+        return obj
+
+    def rollout(self, path: str, obj: dict, live: dict | None) -> None:
+        """Roll out `obj` at once, like an instantly fast controller would."""
+        if "/apis/apps/" not in path:
+            return
+        metadata = obj["metadata"]
+        generation = live["metadata"].get("generation", 1) if live else 1
+        if live is not None and live["spec"] != obj["spec"]:
+            generation += 1
+        metadata["generation"] = generation
+        replicas = obj["spec"].get("replicas", 1)
+        obj["status"] = {
+            "observedGeneration": generation,
+            "replicas": replicas,
+            "updatedReplicas": replicas,
+            "readyReplicas": replicas,
+            "availableReplicas": replicas,
+        }
+
+    def reset_calls(self) -> None:
+        with self.lock:
+            self.calls.clear()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeApiServer
+
+    def setup(self):
+        super().setup()
+        # Don't let Nagle's algorithm delay responses written in two parts.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        del args
+
+    def respond(self, status: int, obj: dict) -> None:
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def not_found(self) -> None:
+        self.respond(404, {"kind": "Status", "code": 404, "message": "not found"})
+
+    def begin(self, verb: str) -> tuple[str, dict]:
+        url = urlsplit(self.path)
+        with self.server.lock:
+            self.server.calls[verb] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        return url.path, parse_qs(url.query)
+
+    def read_body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_GET(self):
+        path, query = self.begin("GET")
+        with self.server.lock:
+            obj = self.server.objects.get(path)
+            if obj is None:
+                items = [
+                    item
+                    for key, item in self.server.objects.items()
+                    if key.rsplit("/", 1)[0] == path
+                ]
+        if obj is not None:
+            return self.respond(200, obj)
+        selector = query.get("labelSelector", [""])[0]
+        labels = dict(pair.split("=", 1) for pair in selector.split(",") if pair)
+        items = [
+            item
+            for item in items
+            if labels.items() <= item["metadata"].get("labels", {}).items()
+        ]
+        self.respond(200, {"kind": "List", "items": items})
+
+    def do_PATCH(self):
+        path, _ = self.begin("PATCH")
+        body = self.read_body()
+        with self.server.lock:
+            live = self.server.objects.get(path)
+        version = body.get("metadata", {}).get("resourceVersion")
+        if live is not None and version:
+            if version != live["metadata"]["resourceVersion"]:
+                return self.respond(
+                    409, {"kind": "Status", "code": 409, "message": "conflict"}
+                )
+        if "merge-patch" in self.headers["Content-Type"]:
+            if live is None:
+                return self.not_found()
+            return self.respond(200, self.server.put(path, merge(live, body)))
+        if live is None and "apply-patch" not in self.headers["Content-Type"]:
+            return self.not_found()
+        if live is not None and "status" in live:
+            body["status"] = live["status"]
+        self.server.rollout(path, body, live)
+        self.respond(200 if live else 201, self.server.put(path, body))
+
+    def do_POST(self):
+        path, _ = self.begin("POST")
+        body = self.read_body()
+        path += "/" + body["metadata"]["name"]
+        self.server.rollout(path, body, None)
+        self.respond(201, self.server.put(path, body))
+
+    def do_DELETE(self):
+        path, _ = self.begin("DELETE")
+        if self.server.remove(path) is None:
+            return self.not_found()
+        self.respond(200, {"kind": "Status", "status": "Success"})
+
+
+def merge(live: dict, patch: dict) -> dict:
+    """Apply a JSON merge patch (RFC 7386) to a copy of `live`."""
+    merged = dict(live)
+    for key, value in patch.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
@@ -1,10 +1,22 @@
 #!/bin/bash
+# Only what logging in needs is done before sshd starts, everything else runs
+# in the background, so that the DevEnv is reachable as soon as possible.
 export > $HOME/.bashrc
-echo 'source <(kubectl completion bash)
+echo 'source /etc/bash_completion.d/kubectl
 alias k=kubectl
 complete -F __start_kubectl k
 ' >> $HOME/.bashrc
 echo $mounts | base64 -d > config.yaml
 echo -e $authorized_keys > $HOME/.ssh/authorized_keys
-chown -R docker /home/docker
-/usr/sbin/sshd -D
+chown docker: $HOME/.bashrc config.yaml
+/usr/sbin/sshd -D &
+sshd=$!
+
+# The code volume only needs to be walked if its root isn't owned by docker,
+# i.e. it's new or was written by root. Otherwise, like `fsGroupChangePolicy:
+# OnRootMismatch`, assume its contents are owned by docker too.
+if [ "$(stat -c %U $HOME/code)" != docker ]; then
+  chown -R docker: $HOME/code &
+fi
+$HOME/scripts/activity.sh &
+wait $sshd
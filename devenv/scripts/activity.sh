@@ -0,0 +1,32 @@
+#!/bin/bash
+
+# Record open SSH sessions, and HTTP traffic to clones in `clone` mode, as
+# activity on the DevEnv, so that it doesn't hibernate while in use, see
+# `spec.hibernateAfter`. Syncs are recorded by reload.py.
+
+# Whether a clone has an established connection on the DevEnv's port. Clones
+# are checked from inside, since their traffic doesn't go through the DevEnv,
+# which requires `cat` in their first container.
+clone_traffic() {
+  local spec mode port pod
+  spec=$(kubectl get devenv "$envname" -n "$namespace" \
+    -o jsonpath='{.spec.mode}/{.spec.port}') || return 1
+  IFS=/ read -r mode port <<< "$spec"
+  [ "$mode" = clone ] && [ -n "$port" ] || return 1
+  for pod in $(kubectl get pods -n "$namespace" -l "devenv=$envname" \
+      --field-selector=status.phase=Running -o name); do
+    kubectl exec -n "$namespace" "$pod" -- cat /proc/net/tcp /proc/net/tcp6 2> /dev/null |
+      awk -v port="$(printf %04X "$port")" \
+        '{ split($2, addr, ":") } addr[2] == port && $4 == "01" { found = 1 }
+        END { exit !found }' && return 0
+  done
+  return 1
+}
+
+while true; do
+  if pgrep -f '^sshd: .*@' > /dev/null || clone_traffic; then
+    kubectl annotate devenv "$envname" -n "$namespace" --overwrite \
+      "dell.com/devenv-last-activity=$(date -u +%Y-%m-%dT%H:%M:%SZ)" > /dev/null
+  fi
+  sleep 60
+done
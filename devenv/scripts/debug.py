@@ -1,12 +1,25 @@
 #!/usr/bin/env python3
+"""Debug a target workload of the DevEnv interactively.
+
+The DevEnv gets patched once, for the operator to replace the entrypoint of a
+container of the target workload with an idle command, see `spec.debug`. Once
+the new pod's container is running, which is awaited with a watch, the
+original entrypoint is run interactively inside it, e.g. to attach a
+debugger. When it exits, the DevEnv gets patched again to restore the
+workload.
+"""
 
-import os
 import argparse
+import json
+import os
+import shlex
 import subprocess
-from typing import Dict, Literal
-from time import sleep
+import sys
+import time
 
-import yaml
+from kubernetes import client, config, watch
+
+DEBUG_ORIGINAL = "dell.com/devenv-debug-original"
 
 
 def parse_args():
@@ -14,217 +27,177 @@ def parse_args():
         description="Debug pod interactively.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-    argparser.add_argument(
-        "-c",
-        "--config",
-        required=False,
-        default="./config.yaml",
-        help="Configuration file with target manifests and mount paths.",
-    )
     argparser.add_argument(
         "-n",
         "--namespace",
-        default="hzp",
-        required=False,
-        help="Kubernetes namespace of all objects that will be modified.",
+        default=os.getenv("namespace", "default"),
+        help="Kubernetes namespace of the DevEnv and its target workloads.",
+    )
+    argparser.add_argument(
+        "--devenv", default=os.getenv("envname"), help="Name of the DevEnv."
+    )
+    argparser.add_argument(
+        "-k",
+        "--kind",
+        choices=("deployment", "statefulset"),
+        default="deployment",
+        help="Kind of the target workload.",
     )
     argparser.add_argument(
         "-l",
         "--labels",
-        default='',
-        required=False,
+        default="",
         help=(
-            "Labels common to all kubernetes objects that will be manified. "
-            "This must be a comma-separated list (no blanks) of key=value pairs. "
-            "Main use case is to limit to a particular helm release, for example "
-            "with some like `--labels release=test-env-42`."
+            "Labels of the target workload, as one of the DevEnv's mounts. "
+            "This must be a comma-separated list (no blanks) of key=value pairs."
         ),
     )
+    argparser.add_argument(
+        "--container",
+        help="Container to debug, defaults to the first one.",
+    )
+    # Targets used to be read from a configuration file, they're the DevEnv's
+    # mounts now.
+    argparser.add_argument("-c", "--config", help=argparse.SUPPRESS)
+    argparser.add_argument(
+        "--cmd",
+        help=(
+            "Command to run interactively, defaults to the container's "
+            "entrypoint. Required if the entrypoint is the image's default."
+        ),
+    )
+    argparser.add_argument(
+        "-t",
+        "--timeout",
+        type=int,
+        default=300,
+        help="Seconds to wait for the debugged pod to start.",
+    )
     argparser.add_argument(
         "-d",
         "--disable",
         action="store_true",
-        help="Disable debugging instead of enabling it.",
+        help="Only stop debugging and restore the target workload.",
     )
     args = argparser.parse_args()
+    if args.config:
+        argparser.error(
+            "-c/--config is no longer supported, the target workload is picked "
+            "by -l/--labels among the DevEnv's mounts"
+        )
     if args.labels:
-        args.labels = dict(l.split("=", 1) for l in args.labels.split(","))
-    else:
-        args.labels = {}
+        args.labels = dict(lbl.split("=", 1) for lbl in args.labels.split(","))
+    elif not args.disable:
+        argparser.error("the following arguments are required: -l/--labels")
     return args
 
 
-def load_config(path: str) -> dict:
-    if not os.path.exists(path):
-        raise OSError(f"Can't find configuration file at '{path}'.")
-    with open(path) as fobj:
-        config = yaml.safe_load(fobj)
-    assert "mounts" in config, config
-    for mount in config["mounts"]:
-        assert isinstance(mount, dict), repr(mount)
-        for attr in ("kind", "labels", "mountPath"):
-            assert attr in mount, mount
-    return config
-
-
-def get_manifest(
-    namespace: str, kind: Literal["deployment", "statefulset"], labels: Dict[str, str]
-) -> dict:
-    labels_str = ",".join("=".join((key, val)) for key, val in labels.items())
-    cmd = ["kubectl", "-n", namespace, "get", kind, "-l", labels_str, "-o", "yaml"]
-    proc = subprocess.run(cmd, capture_output=True, check=True, timeout=5)
-    manifest = yaml.safe_load(proc.stdout)
-    assert manifest.get("kind") == "List"
-    # TODO: Support multiple matches?
-    assert len(manifest["items"]) == 1
-    return manifest["items"][0]
-
-
-def apply_manifest(namespace: str, manifest: dict) -> None:
-    cmd = ["kubectl", "-n", namespace, "apply", "-f", "-"]
-    subprocess.run(cmd, input=yaml.safe_dump(manifest).encode(), check=True, timeout=5)
-
-
-def add_mount(
-    *,
-    manifest: str,
-    volume_name: str,
-    pvc_name: str,
-    mount_path: str,
-    sub_path: str = "",
-) -> None:
-    # Configure volume.
-    volumes = manifest["spec"]["template"]["spec"]["volumes"]
-    for volume in volumes:
-        if volume["name"] == volume_name:
-            # Update existing volume.
-            volume["persistentVolumeClaim"]["claimName"] = pvc_name
-            break
-    else:
-        # Add new volume.
-        volumes.append(
-            {"name": volume_name, "persistentVolumeClaim": {"claimName": pvc_name}}
-        )
-    # Configure volume mount.
-    for container in manifest["spec"]["template"]["spec"]["containers"]:
-        mounts = container["volumeMounts"]
-        for mount in mounts:
-            if mount["name"] == volume_name:
-                # Update existing volume mount.
-                mount["mountPath"] = mount_path
-                mount["readWrjteMany"] = True
-                if sub_path:
-                    mount["subPath"] = sub_path
-                else:
-                    mount.pop("subPath", None)
-                break
-        else:
-            # Add new volume mount.
-            mount = {"name": volume_name, "mountPath": mount_path}
-            if sub_path:
-                mount["subPath"] = sub_path
-            mounts.append(mount)
-
-
-def remove_mount(*, manifest: str, volume_name: str) -> None:
-    # Remove volume.
-    volumes = manifest["spec"]["template"]["spec"]["volumes"]
-    for i, volume in reversed(list(enumerate(volumes))):
-        if volume["name"] == volume_name:
-            volumes.pop(i)
-    # Remove volume mount.
-    for container in manifest["spec"]["template"]["spec"]["containers"]:
-        mounts = container["volumeMounts"]
-        for i, mount in reversed(list(enumerate(mounts))):
-            if mount["name"] == volume_name:
-                mounts.pop(i)
-
-
-def set_sleep_cmd(
-    *,
-    manifest: str,
-) -> None:
-    #import ipdb;ipdb.set_trace()
-    old_cmd = manifest['spec']['template']['spec']['containers'][0]['args']
-    manifest['spec']['template']['spec']['containers'][0]['args'] = ['/bin/sleep', '47000']
-    return ' '.join(old_cmd)
-
-
-def unset_sleep_cmd(*, manifest: str, old_cmd: str) -> None:
-    manifest['spec']['template']['spec']['containers'][0]['args'] = old_cmd.split(' ')
-#    manifest['spec']['template']['spec']['containers'][0]['args'] = ['/usr/local/bin/uwsgi', '--ini=uwsgi.ini', '--plugins=python3', '--http=0.0.0.0:8080', '--wsgi-file=v2/mist_api_v2/__main__.py', '--callable=application', '--master', '--processes=8', '--max-requests=100', '--honour-stdin', '--enable-threads']
-
-
-def scale_to_zero(*, manifest: str) -> None:
-    manifest['spec']['replicas'] = 0
+def patch_debug(custom: client.CustomObjectsApi, args, debug: dict | None) -> None:
+    custom.patch_namespaced_custom_object(
+        "dell.com",
+        "v1",
+        args.namespace,
+        "devenvs",
+        args.devenv,
+        {"spec": {"debug": debug}},
+    )
 
 
-def scale_to_one(*, manifest: str) -> None:
-    manifest['spec']['replicas'] = 1
+def wait_for_workload(apps: client.AppsV1Api, args, deadline: float) -> tuple:
+    """Wait for the operator to debug the target, return it and its original."""
+    list_func = {
+        "deployment": apps.list_namespaced_deployment,
+        "statefulset": apps.list_namespaced_stateful_set,
+    }[args.kind]
+    stream = watch.Watch().stream(
+        list_func, args.namespace, timeout_seconds=remaining(deadline)
+    )
+    for event in stream:
+        workload = event["object"]
+        annotations = workload.metadata.annotations or {}
+        if event["type"] == "DELETED" or DEBUG_ORIGINAL not in annotations:
+            continue
+        original = json.loads(annotations[DEBUG_ORIGINAL])
+        if original["labels"] == args.labels:
+            stream.close()
+            return workload, original
+    raise TimeoutError(f"The {args.kind} with labels {args.labels} wasn't debugged.")
+
+
+def wait_for_pod(core: client.CoreV1Api, args, workload, original, deadline) -> str:
+    """Wait for a pod of the workload to run the idle command, return its name."""
+    container = original["container"]
+    idle_cmd = next(
+        c.command for c in workload.spec.template.spec.containers if c.name == container
+    )
+    selector = ",".join(
+        f"{key}={val}" for key, val in workload.spec.selector.match_labels.items()
+    )
+    stream = watch.Watch().stream(
+        core.list_namespaced_pod,
+        args.namespace,
+        label_selector=selector,
+        timeout_seconds=remaining(deadline),
+    )
+    for event in stream:
+        pod = event["object"]
+        if event["type"] == "DELETED" or pod.metadata.deletion_timestamp:
+            continue
+        if not any(
+            c.name == container and c.command == idle_cmd for c in pod.spec.containers
+        ):
+            continue
+        if any(
+            status.name == container and status.state.running
+            for status in pod.status.container_statuses or ()
+        ):
+            stream.close()
+            return pod.metadata.name
+    raise TimeoutError(f"No pod of {workload.metadata.name} started in time.")
+
+
+def remaining(deadline: float) -> int:
+    return max(1, int(deadline - time.monotonic()))
 
 
 def main():
     args = parse_args()
-    config = load_config(args.config)
-    volume_name = config.get("volume_name", "code")
-    assert "mounts" in config, config
-    for mount in config["mounts"]:
-        assert isinstance(mount, dict), repr(mount)
-        for attr in ("kind", "labels", "mountPath"):
-            assert attr in mount, mount
-        if mount["kind"].lower() != "deployment":
-            raise NotImplementedError("Only deployments are supported.")
-        labels={**args.labels, **mount["labels"]}
-        labels_str = ",".join("=".join((key, val)) for key, val in labels.items())
-        manifest = get_manifest(
-            namespace=args.namespace,
-            kind=mount["kind"],
-            labels=labels,
-        )
-        if args.disable:
-            unset_sleep_cmd(manifest=manifest, old_cmd=old_cmd)
+    try:
+        config.load_incluster_config()
+    except config.ConfigException:
+        config.load_kube_config()
+    custom = client.CustomObjectsApi()
+    if args.disable:
+        patch_debug(custom, args, None)
+        return
+    devenv = custom.get_namespaced_custom_object(
+        "dell.com", "v1", args.namespace, "devenvs", args.devenv
+    )
+    if not devenv["spec"].get("mountsEnabled"):
+        sys.exit("Mounts aren't enabled yet, sync your code first.")
+
+    debug = {"labels": args.labels}
+    if args.container:
+        debug["container"] = args.container
+    print(f"Debugging {args.kind} with labels {args.labels}")
+    patch_debug(custom, args, debug)
+    try:
+        deadline = time.monotonic() + args.timeout
+        workload, original = wait_for_workload(client.AppsV1Api(), args, deadline)
+        pod = wait_for_pod(client.CoreV1Api(), args, workload, original, deadline)
+        if args.cmd:
+            cmd = shlex.split(args.cmd)
         else:
-            old_cmd = set_sleep_cmd(
-                manifest=manifest,
-            )
-        scale_to_zero(manifest=manifest)
-        apply_manifest(namespace=args.namespace, manifest=manifest)
-        cmd = f'kubectl delete po --force -n {args.namespace} -l{labels_str}'
-        print('Running command: ', cmd)
-        os.system(cmd)
-        manifest = get_manifest(
-            namespace=args.namespace,
-            kind=mount["kind"],
-            labels=labels,
-        )
-        scale_to_one(manifest=manifest)
-        apply_manifest(namespace=args.namespace, manifest=manifest)
-        sleep(3)
-        cmd = f'kubectl exec -it $(kubectl get po -o name -l{labels_str}) -- {old_cmd} --no-threads-wait --threads 0 --reload-mercy 1 --worker-reload-mercy 2'
-        print('Running command on fg: ', cmd)
-        os.system(cmd)
-        manifest = get_manifest(
-            namespace=args.namespace,
-            kind=mount["kind"],
-            labels=labels,
-        )
-        scale_to_zero(manifest=manifest)
-        apply_manifest(namespace=args.namespace, manifest=manifest)
-        manifest = get_manifest(
-            namespace=args.namespace,
-            kind=mount["kind"],
-            labels=labels,
-        )
-        unset_sleep_cmd(manifest=manifest, old_cmd=old_cmd)
-        apply_manifest(namespace=args.namespace, manifest=manifest)
-        manifest = get_manifest(
-            namespace=args.namespace,
-            kind=mount["kind"],
-            labels=labels,
-        )
-        scale_to_one(manifest=manifest)
-        apply_manifest(namespace=args.namespace, manifest=manifest)
+            cmd = original.get("command", []) + original.get("args", [])
+        if not cmd:
+            sys.exit("The container runs the image's entrypoint, pass it with --cmd.")
+        print(f"Running inside {pod}: {shlex.join(cmd)}")
+        kubectl = ["kubectl", "exec", "-it", "-n", args.namespace, pod]
+        subprocess.run([*kubectl, "-c", original["container"], "--", *cmd])
+    finally:
+        print("Restoring", args.kind)
+        patch_debug(custom, args, None)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""Change many DevEnvs at once, e.g. to disable mounts for release testing.
+
+DevEnvs are selected by namespace and labels. Every one of them that isn't in
+the requested state already gets a single merge patch, in parallel, up to
+`--parallelism` at a time. With `--wait`, a single watch then follows the
+`Ready` condition of all of them, which the operator sets once their target
+pods have been updated. A table with the result of every DevEnv is printed at
+the end, and the exit status is non-zero if any of them failed.
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from kubernetes import client, config, watch
+from kubernetes.client.exceptions import ApiException
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(
+        description="Change many DevEnvs at once.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    argparser.add_argument(
+        "-n",
+        "--namespace",
+        default=os.getenv("namespace", "default"),
+        help="Kubernetes namespace of the DevEnvs.",
+    )
+    argparser.add_argument(
+        "-A",
+        "--all-namespaces",
+        action="store_true",
+        help="Select DevEnvs in all namespaces.",
+    )
+    argparser.add_argument(
+        "-l",
+        "--labels",
+        default="",
+        help=(
+            "Label selector of the DevEnvs, e.g. `team=edge,tier!=prod`. "
+            "All DevEnvs of the namespace are selected if empty."
+        ),
+    )
+    action = argparser.add_mutually_exclusive_group(required=True)
+    action.add_argument(
+        "--enable-mounts",
+        dest="mounts_enabled",
+        action="store_const",
+        const=True,
+        help="Enable mounts.",
+    )
+    action.add_argument(
+        "--disable-mounts",
+        dest="mounts_enabled",
+        action="store_const",
+        const=False,
+        help="Disable mounts.",
+    )
+    action.add_argument("--image", help="Change the image of the environments.")
+    argparser.add_argument(
+        "-j",
+        "--parallelism",
+        type=int,
+        default=16,
+        help="Maximum number of DevEnvs to patch in parallel.",
+    )
+    argparser.add_argument(
+        "-w",
+        "--wait",
+        action="store_true",
+        help=(
+            "Wait for the target pods of changed DevEnvs to be ready. "
+            "Only applies to mount changes."
+        ),
+    )
+    argparser.add_argument(
+        "-t",
+        "--timeout",
+        type=int,
+        default=600,
+        help="Seconds to wait for with `--wait`.",
+    )
+    argparser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only show the DevEnvs that would be changed.",
+    )
+    args = argparser.parse_args()
+    if args.wait and args.image:
+        argparser.error("argument -w/--wait: not allowed with argument --image")
+    return args
+
+
+def list_devenvs(custom: client.CustomObjectsApi, args) -> list[dict]:
+    if args.all_namespaces:
+        resp = custom.list_cluster_custom_object(
+            "dell.com", "v1", "devenvs", label_selector=args.labels
+        )
+    else:
+        resp = custom.list_namespaced_custom_object(
+            "dell.com", "v1", args.namespace, "devenvs", label_selector=args.labels
+        )
+    return sorted(
+        resp["items"],
+        key=lambda devenv: (
+            devenv["metadata"]["namespace"],
+            devenv["metadata"]["name"],
+        ),
+    )
+
+
+def desired_spec(args) -> dict:
+    if args.image:
+        return {"image": args.image}
+    return {"mountsEnabled": args.mounts_enabled}
+
+
+def ready_condition() -> dict:
+    return {
+        "type": "Ready",
+        "status": "False",
+        "reason": "FleetChange",
+        "message": "Changed by fleet.py.",
+        "lastTransitionTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def is_ready(devenv: dict) -> bool:
+    conditions = devenv.get("status", {}).get("conditions", [])
+    return any(c["type"] == "Ready" and c["status"] == "True" for c in conditions)
+
+
+def patch_devenv(custom: client.CustomObjectsApi, devenv: dict, spec: dict) -> None:
+    metadata = devenv["metadata"]
+    body = {"spec": spec}
+    if "mountsEnabled" in spec:
+        # Like reload.py, reset the Ready condition along with the change, so
+        # that waiting for it doesn't return before the operator handled it.
+        body["status"] = {"conditions": [ready_condition()]}
+    custom.patch_namespaced_custom_object(
+        "dell.com", "v1", metadata["namespace"], "devenvs", metadata["name"], body
+    )
+
+
+def patch_all(custom, devenvs: list[dict], spec: dict, results: dict, args) -> None:
+    """Patch all `devenvs` in parallel, recording the result of each."""
+
+    def patch(devenv):
+        metadata = devenv["metadata"]
+        try:
+            patch_devenv(custom, devenv, spec)
+            result = "patched"
+        except ApiException as exc:
+            result = f"failed: {exc.status} {exc.reason}"
+        return (metadata["namespace"], metadata["name"]), result
+
+    with ThreadPoolExecutor(max_workers=args.parallelism) as executor:
+        futures = [executor.submit(patch, devenv) for devenv in devenvs]
+        for done, future in enumerate(as_completed(futures), 1):
+            key, result = future.result()
+            results[key]["result"] = result
+            print(f"[{done}/{len(devenvs)}] {'/'.join(key)}: {result}")
+
+
+def wait_all(custom: client.CustomObjectsApi, results: dict, args) -> None:
+    """Follow the Ready condition of patched DevEnvs, with a single watch."""
+    pending = {key for key, res in results.items() if res["result"] == "patched"}
+    started = time.monotonic()
+    deadline = started + args.timeout
+    if args.all_namespaces:
+        func, func_args = custom.list_cluster_custom_object, ()
+    else:
+        func, func_args = custom.list_namespaced_custom_object, (args.namespace,)
+    while pending and time.monotonic() < deadline:
+        stream = watch.Watch().stream(
+            func,
+            "dell.com",
+            "v1",
+            *func_args,
+            "devenvs",
+            label_selector=args.labels,
+            timeout_seconds=max(1, int(deadline - time.monotonic())),
+        )
+        for event in stream:
+            devenv = event["object"]
+            metadata = devenv["metadata"]
+            key = metadata["namespace"], metadata["name"]
+            if key not in pending:
+                continue
+            if event["type"] == "DELETED":
+                status = results[key]["result"] = "deleted"
+            elif is_ready(devenv):
+                status = "ready"
+                results[key]["ready"] = f"{time.monotonic() - started:.0f}s"
+            else:
+                continue
+            pending.discard(key)
+            print(f"[{len(pending)} left] {'/'.join(key)}: {status}")
+            if not pending:
+                stream.close()
+    for key in pending:
+        results[key]["ready"] = "timeout"
+
+
+def print_table(results: dict) -> None:
+    rows = [("NAMESPACE", "NAME", "RESULT", "READY")]
+    for (namespace, name), res in results.items():
+        rows.append((namespace, name, res["result"], res.get("ready", "")))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(col.ljust(width) for col, width in zip(row, widths)).rstrip())
+
+
+def main():
+    args = parse_args()
+    try:
+        config.load_incluster_config()
+    except config.ConfigException:
+        config.load_kube_config()
+    custom = client.CustomObjectsApi()
+    spec = desired_spec(args)
+
+    devenvs = list_devenvs(custom, args)
+    results = {}
+    changed = []
+    for devenv in devenvs:
+        metadata = devenv["metadata"]
+        key = metadata["namespace"], metadata["name"]
+        if spec.items() <= devenv["spec"].items():
+            results[key] = {"result": "unchanged"}
+        else:
+            results[key] = {"result": "dry run" if args.dry_run else "pending"}
+            changed.append(devenv)
+    print(f"Selected {len(devenvs)} DevEnvs, {len(changed)} to change.")
+    if changed and not args.dry_run:
+        patch_all(custom, changed, spec, results, args)
+        if args.wait:
+            wait_all(custom, results, args)
+    print_table(results)
+    if any(
+        res["result"].startswith("failed") or res.get("ready") == "timeout"
+        for res in results.values()
+    ):
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -67,17 +67,17 @@ def load_config(path: str) -> dict:
     return config
 
 
-def get_manifest(
+def get_manifests(
     namespace: str, kind: Literal["deployment", "statefulset"], labels: dict[str, str]
-) -> dict:
+) -> list[dict]:
     labels_str = ",".join("=".join((key, val)) for key, val in labels.items())
     cmd = ["kubectl", "-n", namespace, "get", kind, "-l", labels_str, "-o", "yaml"]
     proc = subprocess.run(cmd, capture_output=True, check=True, timeout=5)
     manifest = yaml.safe_load(proc.stdout)
     assert manifest.get("kind") == "List"
-    # TODO: Support multiple matches?
-    assert len(manifest["items"]) == 1
-    return manifest["items"][0]
+    if not manifest["items"]:
+        print(f"No {kind} matches labels {labels_str}")
+    return manifest["items"]
 
 
 def apply_manifest(namespace: str, manifest: dict) -> None:
@@ -151,22 +151,22 @@ def main():
             assert attr in mount, mount
         if mount["kind"].lower() != "deployment":
             raise NotImplementedError("Only deployments are supported.")
-        manifest = get_manifest(
+        for manifest in get_manifests(
             namespace=args.namespace,
             kind=mount["kind"],
             labels={**args.labels, **mount["labels"]},
-        )
-        if args.disable:
-            remove_mount(manifest=manifest, volume_name=volume_name)
-        else:
-            add_mount(
-                manifest=manifest,
-                volume_name=volume_name,
-                pvc_name=args.pvc_name,
-                mount_path=mount["mountPath"],
-                sub_path=mount.get("subPath", ""),
-            )
-        apply_manifest(namespace=args.namespace, manifest=manifest)
+        ):
+            if args.disable:
+                remove_mount(manifest=manifest, volume_name=volume_name)
+            else:
+                add_mount(
+                    manifest=manifest,
+                    volume_name=volume_name,
+                    pvc_name=args.pvc_name,
+                    mount_path=mount["mountPath"],
+                    sub_path=mount.get("subPath", ""),
+                )
+            apply_manifest(namespace=args.namespace, manifest=manifest)
 
 
 if __name__ == "__main__":
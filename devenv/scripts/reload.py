@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""Reload the target pods of a DevEnv after its code has been synced.
+
+Changed paths can be given as arguments, relative to the root of the code
+volume. In that case only the pods of the mounts whose subPath covers at least
+one of them are reloaded, otherwise the pods of all mounts are.
+
+All mount selectors are resolved with a single pod list call, and the result
+is cached for `--cache-ttl` seconds. Pods are signalled in parallel over a
+single API client. If target pods read code from a local mirror, see
+`spec.cache` of the DevEnv, the mirror is synced before they are reloaded.
+Mounts get enabled on the DevEnv the first time code is synced, in which case
+`post_mount_pod_cmd` runs in all the new target pods, once the operator
+reports them ready on the DevEnv's `Ready` condition. Every run is recorded
+as activity on the DevEnv, so that it doesn't hibernate while in use, and a
+DevEnv that hibernated anyway is resumed.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import shlex
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+from kubernetes import client, config, watch
+from kubernetes.client.exceptions import ApiException
+from kubernetes.stream import stream
+
+CACHE_PATH = os.path.expanduser("~/.cache/devenv-reload.json")
+LAST_ACTIVITY = "dell.com/devenv-last-activity"
+# Syncs the local mirror of the code volume, see `CACHE_SYNC` in the operator.
+CACHE_SYNC = [
+    "rsync",
+    "-a",
+    "--delete",
+    "--exclude=/.devenv-sync",
+    "/devenv/code/",
+    "/devenv/cache/",
+]
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(
+        description="Reload target pods.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    argparser.add_argument(
+        "-n",
+        "--namespace",
+        default=os.getenv("namespace", "default"),
+        help="Kubernetes namespace of the DevEnv and its target pods.",
+    )
+    argparser.add_argument(
+        "--devenv", default=os.getenv("envname"), help="Name of the DevEnv."
+    )
+    argparser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=30,
+        help="Seconds to reuse the list of target pods for.",
+    )
+    argparser.add_argument(
+        "-j",
+        "--parallelism",
+        type=int,
+        default=16,
+        help="Maximum number of pods to reload in parallel.",
+    )
+    argparser.add_argument(
+        "-t",
+        "--timeout",
+        type=int,
+        default=300,
+        help="Seconds to wait for the target pods to be ready after mounting.",
+    )
+    argparser.add_argument(
+        "changed", nargs="*", help="Changed paths, relative to the code volume."
+    )
+    return argparser.parse_args()
+
+
+def load_mounts() -> list[dict]:
+    mounts = yaml.safe_load(base64.b64decode(os.getenv("mounts", ""))) or []
+    return [mount for mount in mounts if mount.get("mounted", True)]
+
+
+def covers(mount: dict, path: str) -> bool:
+    sub_path = mount.get("subPath", "").strip("/")
+    return not sub_path or path == sub_path or path.startswith(sub_path + "/")
+
+
+def list_target_pods(
+    core: client.CoreV1Api, namespace: str, mounts: list[dict], ttl: float
+) -> tuple[list[list[str]], dict[str, str]]:
+    """Return the names of the running pods that each mount targets.
+
+    Also return the first container of each pod, which commands run in.
+    """
+    key = hashlib.sha256(json.dumps([namespace, mounts]).encode()).hexdigest()
+    try:
+        with open(CACHE_PATH) as fobj:
+            cache = json.load(fobj)
+        if cache["key"] == key and time.time() - cache["time"] < ttl:
+            return cache["pods"], cache["containers"]
+    except (OSError, ValueError, KeyError):
+        pass
+    pods = [
+        pod
+        for pod in core.list_namespaced_pod(namespace).items
+        if pod.status.phase == "Running" and not pod.metadata.deletion_timestamp
+    ]
+    targets = [
+        [
+            pod.metadata.name
+            for pod in pods
+            if mount["labels"].items() <= (pod.metadata.labels or {}).items()
+        ]
+        for mount in mounts
+    ]
+    containers = {pod.metadata.name: pod.spec.containers[0].name for pod in pods}
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    with open(CACHE_PATH, "w") as fobj:
+        json.dump(
+            {
+                "key": key,
+                "time": time.time(),
+                "pods": targets,
+                "containers": containers,
+            },
+            fobj,
+        )
+    return targets, containers
+
+
+def invalidate_cache() -> None:
+    try:
+        os.unlink(CACHE_PATH)
+    except FileNotFoundError:
+        pass
+
+
+def utc_now() -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+def ready_condition() -> dict:
+    return {
+        "type": "Ready",
+        "status": "False",
+        "reason": "MountsEnabled",
+        "message": "Mounts were enabled.",
+        "lastTransitionTime": utc_now(),
+    }
+
+
+def is_ready(devenv: dict) -> bool:
+    conditions = devenv.get("status", {}).get("conditions", [])
+    return any(c["type"] == "Ready" and c["status"] == "True" for c in conditions)
+
+
+def wait_until_ready(custom: client.CustomObjectsApi, args) -> None:
+    """Watch the DevEnv until the operator reports its target pods ready."""
+    stream = watch.Watch().stream(
+        custom.list_namespaced_custom_object,
+        "dell.com",
+        "v1",
+        args.namespace,
+        "devenvs",
+        field_selector=f"metadata.name={args.devenv}",
+        timeout_seconds=args.timeout,
+    )
+    for event in stream:
+        if event["type"] != "DELETED" and is_ready(event["object"]):
+            stream.close()
+            return
+    raise TimeoutError(f"The pods of {args.devenv} weren't ready in time.")
+
+
+def pod_exec(
+    core: client.CoreV1Api,
+    namespace: str,
+    pod: str,
+    cmd: list[str],
+    container: str | None = None,
+):
+    print(f"Executing inside {pod}: {shlex.join(cmd)}")
+    output = stream(
+        core.connect_get_namespaced_pod_exec,
+        pod,
+        namespace,
+        container=container,
+        command=cmd,
+        stderr=True,
+        stdin=False,
+        stdout=True,
+        tty=False,
+    )
+    if output:
+        print(output, end="" if output.endswith("\n") else "\n")
+
+
+def reload_pod(
+    core: client.CoreV1Api, namespace: str, pod: str, container: str
+) -> None:
+    cache_container = os.getenv("cache_container")
+    if cache_container:
+        pod_exec(core, namespace, pod, CACHE_SYNC, container=cache_container)
+    signal = ["kill", f"-{os.getenv('reload_signal')}", "1"]
+    pod_exec(core, namespace, pod, signal, container=container)
+    reload_cmd = os.getenv("reload_cmd")
+    if reload_cmd:
+        pod_exec(core, namespace, pod, shlex.split(reload_cmd), container=container)
+
+
+def run_in_pods(func, pods: list[str], parallelism: int) -> list[str]:
+    """Call `func` for every pod in parallel, return the pods that are gone."""
+    gone = []
+
+    def run(pod):
+        try:
+            func(pod)
+        except ApiException as exc:
+            if exc.status != 404:
+                raise
+            gone.append(pod)
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        for _ in executor.map(run, pods):
+            pass
+    return gone
+
+
+def main():
+    args = parse_args()
+    try:
+        config.load_incluster_config()
+    except config.ConfigException:
+        config.load_kube_config()
+    core = client.CoreV1Api()
+    custom = client.CustomObjectsApi()
+    mounts = load_mounts()
+
+    targets, containers = list_target_pods(core, args.namespace, mounts, args.cache_ttl)
+    pods = sorted(
+        {
+            pod
+            for mount, mount_pods in zip(mounts, targets)
+            if not args.changed or any(covers(mount, path) for path in args.changed)
+            for pod in mount_pods
+        }
+    )
+    gone = run_in_pods(
+        lambda pod: reload_pod(core, args.namespace, pod, containers[pod]),
+        pods,
+        args.parallelism,
+    )
+    if gone:
+        # Pods were replaced since they got cached. New pods already run the
+        # latest code, so there's nothing else to reload.
+        print(f"Pods {', '.join(gone)} are gone, refreshing cache.")
+        invalidate_cache()
+
+    # Record the sync as activity, and enable mounts if needed.
+    devenv = custom.patch_namespaced_custom_object(
+        "dell.com",
+        "v1",
+        args.namespace,
+        "devenvs",
+        args.devenv,
+        {"metadata": {"annotations": {LAST_ACTIVITY: utc_now()}}},
+    )
+    if devenv["spec"].get("hibernated"):
+        # It hibernated while code was being synced.
+        print("Resuming the DevEnv")
+        devenv = custom.patch_namespaced_custom_object(
+            "dell.com",
+            "v1",
+            args.namespace,
+            "devenvs",
+            args.devenv,
+            {"spec": {"hibernated": False}},
+        )
+    if devenv["spec"].get("mountsEnabled"):
+        return
+    print("Enabling mounts")
+    # Reset the Ready condition along with the change, so that waiting for it
+    # doesn't return before the operator handled it.
+    custom.patch_namespaced_custom_object(
+        "dell.com",
+        "v1",
+        args.namespace,
+        "devenvs",
+        args.devenv,
+        {
+            "spec": {"mountsEnabled": True},
+            "status": {"conditions": [ready_condition()]},
+        },
+    )
+    invalidate_cache()
+    post_mount_pod_cmd = os.getenv("post_mount_pod_cmd")
+    if not post_mount_pod_cmd:
+        print("No post mount command to be executed inside the pods")
+        return
+    # Mounting replaces the target pods, the command must run in the new ones.
+    print("Waiting for the target pods to be ready")
+    wait_until_ready(custom, args)
+    print("Executing post mount command inside each pod")
+    targets, containers = list_target_pods(core, args.namespace, mounts, args.cache_ttl)
+    pods = sorted({pod for mount_pods in targets for pod in mount_pods})
+    run_in_pods(
+        lambda pod: pod_exec(
+            core,
+            args.namespace,
+            pod,
+            shlex.split(post_mount_pod_cmd),
+            container=containers[pod],
+        ),
+        pods,
+        args.parallelism,
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,707 @@
+#!/usr/bin/env python3
+"""Incremental code sync between a developer's checkout and a DevEnv.
+
+`sync.py watch` runs on the developer's machine. It keeps a persisted index of
+the local tree (path, size, mtime and content hash), so it only has to hash
+files whose size or mtime changed, and it streams changed files over a single
+long-lived SSH connection to `sync.py serve`, which runs inside the DevEnv pod
+and writes them to the code volume.
+
+Both ends speak a simple framed protocol over the SSH session's stdin/stdout.
+Every frame is a 4-byte big-endian header length, a JSON header and, if the
+header has a `size`, that many bytes of payload.
+
+Large files, e.g. build artifacts that only differ by a few blocks between
+builds, are split into content-defined chunks, see `chunk_ends`. The DevEnv
+keeps the chunks of its files in a store on the code volume, so only the
+chunks it doesn't have yet are sent, and the file is then reassembled from
+the store next to its destination and renamed over it.
+"""
+
+import argparse
+import contextlib
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import shlex
+import struct
+import subprocess
+import sys
+import time
+import zlib
+from collections.abc import Iterator
+
+FRAME = struct.Struct(">I")
+STATE_DIR = ".devenv-sync"
+CLIENT_STATE_DIR = os.path.join(
+    os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "devenv-sync"
+)
+COMPRESS_MIN_SIZE = 512
+MAX_RELOAD_PATHS = 1000
+
+# A chunk ends after the first run of `CHUNK_RUN` bytes that are all marked in
+# `CHUNK_MARKS`, between `CHUNK_MIN_SIZE` and `CHUNK_MAX_SIZE` bytes into it.
+CHUNK_MIN_SIZE = 16 << 10
+CHUNK_MAX_SIZE = 256 << 10
+CHUNK_RUN = 12
+# Bytes of a file that are read at a time to chunk it, see `iter_chunks`.
+CHUNK_WINDOW = 4 * CHUNK_MAX_SIZE
+# Maps about half of the byte values to 1 and the rest to 0, by the bits of a
+# fixed digest, so that both ends cut chunks at the same places.
+_CHUNK_SEED = hashlib.sha256(b"devenv-sync").digest()
+CHUNK_MARKS = bytes((_CHUNK_SEED[byte >> 3] >> (byte & 7)) & 1 for byte in range(256))
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(
+        description="Incrementally sync code to a DevEnv.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = argparser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser(
+        "serve",
+        help="Receive files over stdin/stdout. Runs inside the DevEnv.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    serve.add_argument(
+        "--reload-cmd",
+        default="./scripts/reload.sh",
+        help=(
+            "Command to run after a batch of changes has been written. The "
+            "changed paths are appended to its arguments."
+        ),
+    )
+    serve.add_argument("root", help="Directory to write synced files to.")
+
+    watch = subparsers.add_parser(
+        "watch",
+        help="Watch a local directory and sync changes to a DevEnv.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    watch.add_argument("-r", "--remote", required=True, help="SSH URI of the DevEnv.")
+    watch.add_argument(
+        "--remote-root",
+        default="/home/docker/code",
+        help="Directory on the DevEnv to sync files to.",
+    )
+    watch.add_argument(
+        "-e",
+        "--exclude",
+        action="append",
+        default=[],
+        help=(
+            "Glob pattern of paths to leave out. It is matched against every "
+            "path component and the whole relative path. A pattern without "
+            "wildcards that starts with a dot also matches file extensions. "
+            "Can be given multiple times."
+        ),
+    )
+    watch.add_argument(
+        "-i",
+        "--interval",
+        type=float,
+        default=1.0,
+        help="Seconds to wait between scans of the local directory.",
+    )
+    watch.add_argument(
+        "--once",
+        action="store_true",
+        help="Exit after the first sync instead of watching for changes.",
+    )
+    watch.add_argument(
+        "--no-reload",
+        action="store_true",
+        help="Don't reload the target pods after syncing.",
+    )
+    watch.add_argument(
+        "--chunk-threshold",
+        type=int,
+        default=1 << 20,
+        help=(
+            "Size in bytes from which files are sent in content-defined chunks, "
+            "only those the DevEnv doesn't have yet. 0 sends files whole."
+        ),
+    )
+    watch.add_argument(
+        "--devenv",
+        help=(
+            "NAMESPACE/NAME of the DevEnv, to resume it with kubectl before "
+            "connecting if it's hibernated."
+        ),
+    )
+    watch.add_argument("root", nargs="?", default=".", help="Directory to sync.")
+    return argparser.parse_args()
+
+
+def send(stream, header: dict, payload: bytes = b"") -> None:
+    if payload:
+        header = {**header, "size": len(payload)}
+    data = json.dumps(header).encode()
+    stream.write(FRAME.pack(len(data)) + data)
+    if payload:
+        stream.write(payload)
+
+
+def recv(stream) -> tuple[dict | None, bytes]:
+    raw = stream.read(FRAME.size)
+    if len(raw) < FRAME.size:
+        return None, b""
+    header = json.loads(read_exactly(stream, FRAME.unpack(raw)[0]))
+    return header, read_exactly(stream, header.get("size", 0))
+
+
+def read_exactly(stream, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise EOFError("Connection closed in the middle of a frame.")
+    return data
+
+
+def is_excluded(relpath: str, patterns: list[str]) -> bool:
+    names = relpath.split("/")
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(relpath, pattern):
+            return True
+        for name in names:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+            if (
+                pattern.startswith(".")
+                and not any(char in pattern for char in "*?[")
+                and name.endswith(pattern)
+            ):
+                return True
+    return False
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fobj:
+        while chunk := fobj.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def chunk_ends(data: bytes) -> list[int]:
+    """Return the end offsets of the content-defined chunks of `data`.
+
+    Where a chunk ends only depends on the bytes right before, so inserting
+    or removing bytes only changes the chunks around them, unlike with blocks
+    of a fixed size. Runs of marked bytes are found with `bytes.translate` and
+    `bytes.find`, which is much faster than a rolling hash in Python.
+    """
+    marks = data.translate(CHUNK_MARKS)
+    run = b"\x01" * CHUNK_RUN
+    ends, start = [], 0
+    while start < len(data):
+        end = min(start + CHUNK_MAX_SIZE, len(data))
+        found = marks.find(run, start + CHUNK_MIN_SIZE - CHUNK_RUN, end)
+        start = end if found < 0 else found + CHUNK_RUN
+        ends.append(start)
+    return ends
+
+
+def chunks_of(data: bytes) -> list[tuple[str, int, int]]:
+    """Return the digest, start and end offset of each chunk of `data`."""
+    view = memoryview(data)
+    ends = chunk_ends(data)
+    return [
+        (hashlib.sha256(view[start:end]).hexdigest(), start, end)
+        for start, end in zip([0, *ends], ends)
+    ]
+
+
+def iter_chunks(fobj) -> Iterator[bytes]:
+    """Yield the chunks of a file object, like `chunks_of` would cut them.
+
+    The file is read in windows of `CHUNK_WINDOW` bytes, so that chunking a
+    large file only needs a few times `CHUNK_MAX_SIZE` bytes of memory. Every
+    chunk but the last one of a window is final. The last one is carried over
+    to the next window, unless the end of the file was reached.
+    """
+    data = b""
+    while window := fobj.read(CHUNK_WINDOW):
+        data += window
+        ends = chunk_ends(data)
+        start = 0
+        for end in ends[:-1]:
+            yield data[start:end]
+            start = end
+        data = data[start:]
+    if data:
+        yield data
+
+
+def scan(root: str, excludes: list[str], cache: dict) -> dict:
+    """Return an index of all files under `root`.
+
+    The index maps relative paths to `[size, mtime_ns, digest, mode]`. Symbolic
+    links are indexed with a digest of `link:<target>` and no mode. Digests
+    are reused from `cache` for files whose size and mtime haven't changed.
+    """
+    index = {}
+    stack = [""]
+    while stack:
+        reldir = stack.pop()
+        try:
+            entries = list(os.scandir(os.path.join(root, reldir)))
+        except OSError:
+            continue
+        for entry in entries:
+            relpath = f"{reldir}/{entry.name}" if reldir else entry.name
+            if relpath == STATE_DIR or is_excluded(relpath, excludes):
+                continue
+            try:
+                if entry.is_symlink():
+                    target = os.readlink(entry.path)
+                    index[relpath] = [0, 0, f"link:{target}", None]
+                elif entry.is_dir():
+                    stack.append(relpath)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    cached = cache.get(relpath)
+                    if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+                        digest = cached[2]
+                    else:
+                        digest = file_digest(entry.path)
+                    mode = stat.st_mode & 0o7777
+                    index[relpath] = [stat.st_size, stat.st_mtime_ns, digest, mode]
+            except OSError:
+                # The file was removed or replaced while scanning.
+                continue
+    return index
+
+
+def load_index(path: str) -> dict:
+    try:
+        with open(path) as fobj:
+            return json.load(fobj)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(path: str, index: dict) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as fobj:
+        json.dump(index, fobj)
+    os.replace(path + ".tmp", path)
+
+
+def safe_join(root: str, relpath: str) -> str:
+    path = os.path.normpath(os.path.join(root, relpath))
+    if os.path.isabs(relpath) or not path.startswith(root + os.sep):
+        raise ValueError(f"Refusing to write outside of {root}: {relpath}")
+    return path
+
+
+def temp_path(path: str) -> str:
+    """Path to write a file at before renaming it over `path`."""
+    return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.devenv-sync")
+
+
+def write_file(root: str, header: dict, payload: bytes) -> None:
+    """Atomically replace a file with the payload of a `put` frame."""
+    path = safe_join(root, header["path"])
+    if header.get("z"):
+        payload = zlib.decompress(payload)
+    if hashlib.sha256(payload).hexdigest() != header["digest"]:
+        raise ValueError(f"Digest mismatch for {header['path']}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = temp_path(path)
+    with open(tmp_path, "wb") as fobj:
+        fobj.write(payload)
+    os.chmod(tmp_path, header["mode"])
+    os.utime(tmp_path, ns=(header["mtime_ns"], header["mtime_ns"]))
+    os.replace(tmp_path, path)
+
+
+def assemble_file(root: str, header: dict) -> None:
+    """Atomically replace a file with the chunks of an `assemble` frame.
+
+    The chunks are concatenated from the store next to the file, which is
+    only renamed over it once complete, so pods never see a partial file.
+    """
+    path = safe_join(root, header["path"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = temp_path(path)
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, "wb") as fobj:
+            for chunk in header["chunks"]:
+                with open(store_path(root, "chunks", chunk), "rb") as cobj:
+                    data = cobj.read()
+                digest.update(data)
+                fobj.write(data)
+        if digest.hexdigest() != header["digest"]:
+            raise ValueError(f"Digest mismatch for {header['path']}")
+        os.chmod(tmp_path, header["mode"])
+        os.utime(tmp_path, ns=(header["mtime_ns"], header["mtime_ns"]))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    recipe = json.dumps(header["chunks"]).encode()
+    write_atomically(store_path(root, "recipes", header["digest"]), recipe)
+
+
+def write_link(root: str, header: dict) -> None:
+    path = safe_join(root, header["path"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = temp_path(path)
+    if os.path.lexists(tmp_path):
+        os.unlink(tmp_path)
+    os.symlink(header["target"], tmp_path)
+    os.replace(tmp_path, path)
+
+
+def store_path(root: str, kind: str, digest: str) -> str:
+    """Path of a chunk, or of the recipe of a file, in the store.
+
+    Both are named after the digest of their content. A recipe is the list of
+    the digests of the chunks of a file.
+    """
+    if len(digest) != 64 or digest.strip("0123456789abcdef"):
+        raise ValueError(f"Invalid digest {digest!r}")
+    return os.path.join(root, STATE_DIR, kind, digest[:2], digest)
+
+
+def write_atomically(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as fobj:
+        fobj.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def write_chunk(root: str, header: dict, payload: bytes) -> None:
+    if header.get("z"):
+        payload = zlib.decompress(payload)
+    if hashlib.sha256(payload).hexdigest() != header["digest"]:
+        raise ValueError(f"Digest mismatch for chunk {header['digest']}")
+    write_atomically(store_path(root, "chunks", header["digest"]), payload)
+
+
+def store_chunks(root: str, relpath: str, entry: list | None) -> None:
+    """Add the chunks of the DevEnv's version of a file to the store.
+
+    Unless it was assembled from chunks, e.g. if it was sent whole, the file
+    is chunked like the client would, so that a new version of it only needs
+    the chunks that changed.
+    """
+    if not entry or entry[3] is None:
+        return
+    recipe = store_path(root, "recipes", entry[2])
+    if os.path.exists(recipe):
+        return
+    whole, chunks = hashlib.sha256(), []
+    with open(safe_join(root, relpath), "rb") as fobj:
+        for chunk in iter_chunks(fobj):
+            whole.update(chunk)
+            digest = hashlib.sha256(chunk).hexdigest()
+            path = store_path(root, "chunks", digest)
+            if not os.path.exists(path):
+                write_atomically(path, chunk)
+            chunks.append(digest)
+    if whole.hexdigest() != entry[2]:
+        # Changed since the last scan, its chunks are collected eventually.
+        return
+    write_atomically(recipe, json.dumps(chunks).encode())
+
+
+def collect_chunks(root: str, index: dict) -> None:
+    """Delete the recipes and chunks of files that are no longer synced."""
+    digests = {entry[2] for entry in index.values()}
+    used = set()
+    for path in glob.glob(os.path.join(root, STATE_DIR, "recipes", "*", "*")):
+        if os.path.basename(path) in digests:
+            with open(path) as fobj:
+                used.update(json.load(fobj))
+        else:
+            os.unlink(path)
+    for path in glob.glob(os.path.join(root, STATE_DIR, "chunks", "*", "*")):
+        if os.path.basename(path) not in used:
+            os.unlink(path)
+
+
+def serve(args) -> None:
+    root = os.path.abspath(args.root)
+    index_path = os.path.join(root, STATE_DIR, "index.json")
+    index = load_index(index_path)
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    changed, errors = [], []
+    assembled = False
+    while True:
+        header, payload = recv(stdin)
+        if header is None:
+            break
+        op = header["op"]
+        try:
+            if op == "hello":
+                index = scan(root, header["excludes"], index)
+                save_index(index_path, index)
+                state = {path: entry[2] for path, entry in index.items()}
+                send(stdout, {"op": "state"}, json.dumps(state).encode())
+            elif op == "want":
+                # Best effort, the client sends whatever is missing anyway.
+                with contextlib.suppress(OSError):
+                    store_chunks(root, header["path"], index.get(header["path"]))
+                missing = [
+                    digest
+                    for digest in dict.fromkeys(header["chunks"])
+                    if not os.path.exists(store_path(root, "chunks", digest))
+                ]
+                send(stdout, {"op": "missing", "chunks": missing})
+            elif op == "chunk":
+                write_chunk(root, header, payload)
+            elif op in ("put", "assemble"):
+                if op == "put":
+                    write_file(root, header, payload)
+                else:
+                    assemble_file(root, header)
+                    assembled = True
+                stat = os.stat(safe_join(root, header["path"]))
+                index[header["path"]] = [
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    header["digest"],
+                    header["mode"],
+                ]
+                changed.append(header["path"])
+            elif op == "link":
+                write_link(root, header)
+                index[header["path"]] = [0, 0, f"link:{header['target']}", None]
+                changed.append(header["path"])
+            elif op == "delete":
+                path = safe_join(root, header["path"])
+                if os.path.lexists(path):
+                    os.unlink(path)
+                index.pop(header["path"], None)
+                changed.append(header["path"])
+            elif op == "commit":
+                save_index(index_path, index)
+                if assembled:
+                    collect_chunks(root, index)
+                    assembled = False
+                if header.get("reload") and changed and args.reload_cmd:
+                    # Pass the changed paths so that only the affected pods
+                    # get reloaded, unless there are too many to fit in argv.
+                    changed = sorted(set(changed))
+                    if len(changed) > MAX_RELOAD_PATHS:
+                        changed = []
+                    # Keep stdout for the protocol, SSH forwards stderr to the
+                    # developer's terminal.
+                    subprocess.run(
+                        shlex.split(args.reload_cmd) + changed,
+                        stdout=sys.stderr,
+                        check=False,
+                    )
+                send(
+                    stdout,
+                    {"op": "ack", "id": header["id"], "errors": errors},
+                )
+                changed, errors = [], []
+            else:
+                raise ValueError(f"Unknown operation {op}")
+        except (OSError, ValueError) as exc:
+            if op in ("hello", "want", "commit"):
+                # The client is waiting for a reply, let it reconnect.
+                raise
+            errors.append(f"{header.get('path', op)}: {exc}")
+        stdout.flush()
+
+
+class Connection:
+    """A `sync.py serve` process on the DevEnv, reached over SSH."""
+
+    def __init__(self, remote: str, remote_root: str, chunk_threshold: int = 0):
+        cmd = [
+            "ssh",
+            "-o",
+            "StrictHostKeyChecking=no",
+            "-o",
+            "ServerAliveInterval=30",
+            remote,
+            "--",
+            "python3",
+            "scripts/sync.py",
+            "serve",
+            shlex.quote(remote_root),
+        ]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.chunk_threshold = chunk_threshold
+        self.commits = 0
+        # Payload bytes sent by the last push.
+        self.sent = 0
+
+    def hello(self, excludes: list[str]) -> dict:
+        """Return the digests of the files that exist on the DevEnv."""
+        send(self.proc.stdin, {"op": "hello", "excludes": excludes})
+        self.proc.stdin.flush()
+        header, payload = recv(self.proc.stdout)
+        if header is None:
+            raise EOFError("Connection to DevEnv closed.")
+        return json.loads(payload)
+
+    def push(self, root: str, puts: dict, deletes: list, reload: bool) -> list:
+        """Send changed files and deletions, return the errors reported."""
+        self.sent = 0
+        for relpath, (_, mtime_ns, digest, mode) in puts.items():
+            if digest.startswith("link:"):
+                send(
+                    self.proc.stdin,
+                    {"op": "link", "path": relpath, "target": digest[5:]},
+                )
+                continue
+            with open(os.path.join(root, relpath), "rb") as fobj:
+                data = fobj.read()
+            header = {
+                "op": "put",
+                "path": relpath,
+                "mode": mode,
+                "mtime_ns": mtime_ns,
+                "digest": hashlib.sha256(data).hexdigest(),
+            }
+            if self.chunk_threshold and len(data) >= self.chunk_threshold:
+                self.push_chunks(header, data)
+            else:
+                self.send_payload(header, data)
+        for relpath in deletes:
+            send(self.proc.stdin, {"op": "delete", "path": relpath})
+        self.commits += 1
+        send(self.proc.stdin, {"op": "commit", "id": self.commits, "reload": reload})
+        self.proc.stdin.flush()
+        header, _ = recv(self.proc.stdout)
+        if header is None:
+            raise EOFError("Connection to DevEnv closed.")
+        return header["errors"]
+
+    def push_chunks(self, header: dict, data: bytes) -> None:
+        """Send a file as chunks, only those that the DevEnv doesn't have."""
+        chunks = chunks_of(data)
+        digests = [digest for digest, _, _ in chunks]
+        send(self.proc.stdin, {"op": "want", "path": header["path"], "chunks": digests})
+        self.proc.stdin.flush()
+        reply, _ = recv(self.proc.stdout)
+        if reply is None:
+            raise EOFError("Connection to DevEnv closed.")
+        missing = set(reply["chunks"])
+        for digest, start, end in chunks:
+            if digest in missing:
+                missing.discard(digest)
+                self.send_payload({"op": "chunk", "digest": digest}, data[start:end])
+        send(self.proc.stdin, {**header, "op": "assemble", "chunks": digests})
+
+    def send_payload(self, header: dict, data: bytes) -> None:
+        """Send a frame, with its payload compressed if that makes it smaller."""
+        if len(data) >= COMPRESS_MIN_SIZE:
+            compressed = zlib.compress(data, 1)
+            if len(compressed) < len(data):
+                header, data = {**header, "z": True}, compressed
+        send(self.proc.stdin, header, data)
+        self.sent += len(data)
+
+    def close(self) -> None:
+        if self.proc.stdin:
+            self.proc.stdin.close()
+        self.proc.wait()
+
+
+def resume(devenv: str) -> None:
+    """Resume the DevEnv if it's hibernated, and wait for it to be ready.
+
+    This runs the resume command that the operator keeps in the status of the
+    DevEnv. Errors are only reported, connecting will fail anyway.
+    """
+    namespace, name = devenv.split("/", 1)
+    jsonpath = "{.spec.hibernated} {.status.create_update_dev_env.resume}"
+    cmd = [
+        "kubectl",
+        "-n",
+        namespace,
+        "get",
+        "devenv",
+        name,
+        "-o",
+        "jsonpath=" + jsonpath,
+    ]
+    try:
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        hibernated, _, resume_cmd = out.partition(" ")
+        if hibernated == "true":
+            print(f"Resuming {devenv}", file=sys.stderr)
+            subprocess.run(resume_cmd, shell=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as exc:
+        print(f"Failed to resume {devenv}: {exc}", file=sys.stderr)
+
+
+def watch(args) -> None:
+    root = os.path.abspath(args.root)
+    key = hashlib.sha256(f"{args.remote}:{args.remote_root}:{root}".encode())
+    index_path = os.path.join(CLIENT_STATE_DIR, key.hexdigest()[:16] + ".json")
+    local = load_index(index_path)
+    backoff = 1
+    while True:
+        if args.devenv:
+            resume(args.devenv)
+        conn = Connection(args.remote, args.remote_root, args.chunk_threshold)
+        try:
+            remote = conn.hello(args.exclude)
+            backoff = 1
+            while True:
+                started = time.monotonic()
+                previous, local = local, scan(root, args.exclude, local)
+                puts = {
+                    relpath: entry
+                    for relpath, entry in local.items()
+                    if remote.get(relpath) != entry[2]
+                }
+                # Only delete files that this client synced before.
+                deletes = [
+                    relpath
+                    for relpath in previous
+                    if relpath not in local and relpath in remote
+                ]
+                if puts or deletes:
+                    size = sum(entry[0] for entry in puts.values())
+                    errors = conn.push(root, puts, deletes, reload=not args.no_reload)
+                    for relpath, entry in puts.items():
+                        remote[relpath] = entry[2]
+                    for relpath in deletes:
+                        remote.pop(relpath, None)
+                    for error in errors:
+                        print(f"Error: {error}", file=sys.stderr)
+                    print(
+                        f"Synced {len(puts)} files ({size / 1024:.1f} KiB, "
+                        f"{conn.sent / 1024:.1f} KiB sent) and "
+                        f"{len(deletes)} deletions in "
+                        f"{time.monotonic() - started:.2f}s"
+                    )
+                save_index(index_path, local)
+                if args.once:
+                    return
+                time.sleep(args.interval)
+        except (EOFError, BrokenPipeError) as exc:
+            print(f"Lost connection to {args.remote}: {exc}", file=sys.stderr)
+            if args.once:
+                sys.exit(1)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+        finally:
+            conn.close()
+
+
+def main():
+    args = parse_args()
+    if args.command == "serve":
+        serve(args)
+    else:
+        try:
+            watch(args)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
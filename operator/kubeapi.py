@@ -0,0 +1,363 @@
+# Copyright © 2023 Dell Inc. or its subsidiaries. All Rights Reserved.
+
+"""Minimal in-process client for the Kubernetes API server.
+
+The operator used to fork a `kubectl` binary for every request, paying for
+kubeconfig parsing, TLS handshakes and API discovery each time. Instead, this
+module loads the cluster configuration once and keeps a single keep-alive
+connection pool to the API server for the lifetime of the process.
+"""
+
+import concurrent.futures
+import contextlib
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import ssl
+import threading
+import time
+from urllib.parse import quote, urlencode
+
+import kubernetes
+import metrics
+import urllib3
+
+API_TIMEOUT = 5
+POOL_SIZE = int(os.getenv("DEVENV_API_POOL_SIZE", "16"))
+# Rate limit of requests to the API server. A QPS of 0 disables it.
+API_QPS = float(os.getenv("DEVENV_API_QPS", "20"))
+API_BURST = int(os.getenv("DEVENV_API_BURST", "40"))
+
+# Priorities of requests to the API server, lowest first. See `priority`.
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+# API group/version of every kind the operator reads or writes.
+API_VERSIONS = {
+    "deployment": "apps/v1",
+    "devenv": "dell.com/v1",
+    "ingress": "networking.k8s.io/v1",
+    "job": "batch/v1",
+    "persistentvolumeclaim": "v1",
+    "pod": "v1",
+    "role": "rbac.authorization.k8s.io/v1",
+    "rolebinding": "rbac.authorization.k8s.io/v1",
+    "service": "v1",
+    "serviceaccount": "v1",
+    "statefulset": "apps/v1",
+}
+KINDS = {
+    "deployment": "Deployment",
+    "devenv": "DevEnv",
+    "ingress": "Ingress",
+    "job": "Job",
+    "persistentvolumeclaim": "PersistentVolumeClaim",
+    "pod": "Pod",
+    "role": "Role",
+    "rolebinding": "RoleBinding",
+    "service": "Service",
+    "serviceaccount": "ServiceAccount",
+    "statefulset": "StatefulSet",
+}
+PLURALS = {"ingress": "ingresses"}
+
+# Objects are applied in stages, lowest first. Kinds in the same stage don't
+# depend on each other and are applied in parallel.
+APPLY_STAGES = {
+    "deployment": 1,
+    "ingress": 1,
+    "job": 1,
+    "rolebinding": 1,
+    "statefulset": 1,
+}
+
+FIELD_MANAGER = "remote-development-operator"
+LAST_APPLIED = "kubectl.kubernetes.io/last-applied-configuration"
+
+
+class ApiError(Exception):
+    """The API server responded with a non-2xx status.
+
+    E.g. 409 if an object was applied or patched with a stale resourceVersion.
+    """
+
+    def __init__(self, method: str, path: str, status: int, body: bytes):
+        self.status = status
+        try:
+            self.details = json.loads(body)
+        except ValueError:
+            self.details = {"message": body.decode(errors="replace")}
+        super().__init__(
+            f"{method} {path} failed with {status}: {self.details.get('message')}"
+        )
+
+
+class RateLimiter:
+    """Token bucket shared by all requests to the API server.
+
+    Up to `burst` requests go through at once, after that `qps` per second.
+    Requests that have to wait for a token get it in order of priority, then
+    of arrival.
+    """
+
+    def __init__(self, qps: float, burst: int):
+        self.qps = qps
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.counter = itertools.count()
+
+    def acquire(self, priority: int) -> None:
+        if not self.qps:
+            return
+        ticket = (priority, next(self.counter))
+        queued = metrics.API_QUEUED.labels(PRIORITY_NAMES[priority])
+        with self.cond:
+            heapq.heappush(self.waiting, ticket)
+            queued.inc()
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(
+                        self.burst, self.tokens + (now - self.updated) * self.qps
+                    )
+                    self.updated = now
+                    if self.waiting[0] != ticket:
+                        self.cond.wait()
+                    elif self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    else:
+                        self.cond.wait((1 - self.tokens) / self.qps)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                queued.dec()
+                # Let the next request in line check for a token.
+                self.cond.notify_all()
+
+
+class Client:
+    """A pooled, authenticated HTTP client for the Kubernetes API server."""
+
+    def __init__(self, configuration: kubernetes.client.Configuration):
+        self.configuration = configuration
+        self.host = configuration.host.rstrip("/")
+        if configuration.verify_ssl:
+            cert_reqs = ssl.CERT_REQUIRED
+        else:
+            cert_reqs = ssl.CERT_NONE
+        self.pool = urllib3.PoolManager(
+            num_pools=2,
+            maxsize=POOL_SIZE,
+            block=True,
+            cert_reqs=cert_reqs,
+            ca_certs=configuration.ssl_ca_cert,
+            cert_file=configuration.cert_file,
+            key_file=configuration.key_file,
+            retries=False,
+        )
+        self.limiter = RateLimiter(API_QPS, API_BURST)
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        query: dict | None = None,
+        body: dict | None = None,
+        content_type: str = "application/json",
+        timeout: float = API_TIMEOUT,
+    ) -> dict:
+        url = self.host + path
+        if query:
+            url += "?" + urlencode(query)
+        headers = {"Accept": "application/json"}
+        token = self.configuration.get_api_key_with_prefix("authorization")
+        if token:
+            headers["Authorization"] = token
+        data = None
+        if body is not None:
+            headers["Content-Type"] = content_type
+            data = json.dumps(body).encode()
+        verb, resource = request_labels(method, path)
+        self.limiter.acquire(_priority.get())
+        started = time.monotonic()
+        try:
+            resp = self.pool.request(
+                method, url, body=data, headers=headers, timeout=timeout
+            )
+        except urllib3.exceptions.TimeoutError:
+            metrics.API_TIMEOUTS.labels(verb, resource).inc()
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            metrics.API_DURATION.labels(verb, resource).observe(elapsed)
+        if not 200 <= resp.status < 300:
+            raise ApiError(method, path, resp.status, resp.data)
+        return json.loads(resp.data) if resp.data else {}
+
+
+_priority = contextvars.ContextVar("priority", default=BACKGROUND)
+_client = None
+_client_lock = threading.Lock()
+_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=POOL_SIZE, thread_name_prefix="kubeapi"
+)
+
+
+def get_client() -> Client:
+    """Return the process-wide client, loading the cluster config on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                configuration = kubernetes.client.Configuration()
+                try:
+                    kubernetes.config.load_incluster_config(
+                        client_configuration=configuration
+                    )
+                except kubernetes.config.ConfigException:
+                    kubernetes.config.load_kube_config(
+                        client_configuration=configuration
+                    )
+                _client = Client(configuration)
+    return _client
+
+
+@contextlib.contextmanager
+def priority(value: int):
+    """Send the requests made within this context with the given priority.
+
+    Worker threads started with `asyncio.to_thread` inherit it.
+    """
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def request_labels(method: str, path: str) -> tuple[str, str]:
+    """Return the API verb and resource (plural) of a request, for metrics."""
+    parts = path.split("/")
+    index = parts.index("namespaces") + 2 if "namespaces" in parts else len(parts)
+    resource = parts[index] if index < len(parts) else ""
+    verb = {"POST": "create", "PATCH": "patch", "DELETE": "delete"}.get(method)
+    if verb is None:
+        verb = "get" if index + 1 < len(parts) else "list"
+    return verb, resource
+
+
+def resource_path(
+    namespace: str, kind: str, name: str = "", api_version: str = ""
+) -> str:
+    kind = kind.lower()
+    api_version = api_version or API_VERSIONS[kind]
+    prefix = "/api/v1" if api_version == "v1" else f"/apis/{api_version}"
+    plural = PLURALS.get(kind, kind + "s")
+    path = f"{prefix}/namespaces/{quote(namespace)}/{plural}"
+    if name:
+        path += "/" + quote(name)
+    return path
+
+
+def apply(namespace: str, manifest: dict) -> dict:
+    """Idempotently create or update the object using server-side apply."""
+    manifest = without_server_fields(manifest)
+    path = resource_path(
+        namespace,
+        manifest["kind"],
+        manifest["metadata"]["name"],
+        manifest["apiVersion"],
+    )
+    return get_client().request(
+        "PATCH",
+        path,
+        query={"fieldManager": FIELD_MANAGER, "force": "true"},
+        body=manifest,
+        content_type="application/apply-patch+yaml",
+    )
+
+
+def apply_all(namespace: str, manifests: list[dict]) -> list[dict]:
+    """Server-side apply a set of objects, in parallel where possible.
+
+    Objects are grouped in stages by kind according to `APPLY_STAGES`. All
+    objects of a stage are applied concurrently and a stage only starts once
+    the previous one has succeeded, so that e.g. a workload's service account
+    and PVC exist before its pods get scheduled.
+    """
+    stages = {}
+    for manifest in manifests:
+        stage = APPLY_STAGES.get(manifest["kind"].lower(), 0)
+        stages.setdefault(stage, []).append(manifest)
+    results = []
+    for stage in sorted(stages):
+        futures = [
+            _executor.submit(contextvars.copy_context().run, apply, namespace, manifest)
+            for manifest in stages[stage]
+        ]
+        # Wait for every apply of the stage before raising the first error.
+        concurrent.futures.wait(futures)
+        results.extend(future.result() for future in futures)
+    return results
+
+
+def without_server_fields(manifest: dict) -> dict:
+    """Shallow copy of `manifest` without fields owned by the API server.
+
+    The resourceVersion of manifests derived from live objects is kept, so
+    that they're only applied if the object didn't change since, see
+    `ApiError`. Templated manifests have none and are applied regardless.
+    """
+    manifest = {key: val for key, val in manifest.items() if key != "status"}
+    metadata = manifest["metadata"] = {
+        key: val for key, val in manifest["metadata"].items() if key != "managedFields"
+    }
+    if LAST_APPLIED in metadata.get("annotations", {}):
+        metadata["annotations"] = {
+            key: val
+            for key, val in metadata["annotations"].items()
+            if key != LAST_APPLIED
+        }
+    return manifest
+
+
+def patch(namespace: str, kind: str, name: str, body: dict) -> dict:
+    return get_client().request(
+        "PATCH",
+        resource_path(namespace, kind, name),
+        body=body,
+        content_type="application/merge-patch+json",
+    )
+
+
+def get(namespace: str, kind: str, name: str) -> dict:
+    return get_client().request("GET", resource_path(namespace, kind, name))
+
+
+def list_(namespace: str, kind: str, labels: dict[str, str]) -> list[dict]:
+    selector = ",".join(f"{key}={val}" for key, val in labels.items())
+    resp = get_client().request(
+        "GET", resource_path(namespace, kind), query={"labelSelector": selector}
+    )
+    # Unlike `kubectl get`, the API omits the type meta of list items.
+    api_version, kind = API_VERSIONS[kind.lower()], KINDS[kind.lower()]
+    for item in resp["items"]:
+        item.setdefault("apiVersion", api_version)
+        item.setdefault("kind", kind)
+    return resp["items"]
+
+
+def delete(namespace: str, kind: str, name: str) -> None:
+    # Like kubectl, also delete dependents, e.g. the pods of a Job.
+    get_client().request(
+        "DELETE",
+        resource_path(namespace, kind, name),
+        query={"propagationPolicy": "Background"},
+    )
@@ -0,0 +1,110 @@
+# Copyright © 2023 Dell Inc. or its subsidiaries. All Rights Reserved.
+
+"""Manifest templates, parsed once and filled in structurally.
+
+Templates are YAML files with `str.format` style placeholders. Rendering one
+used to mean formatting its text and parsing the result with PyYAML on every
+call. Instead, every template is parsed once, with its placeholders replaced
+by sentinels, into a skeleton of mappings, sequences and scalars. Rendering a
+template only re-resolves the few scalars that contain placeholders and
+copies the rest of the skeleton.
+
+A scalar with placeholders is resolved by formatting its source text and
+loading that as YAML, exactly like it would if the whole template was
+formatted and loaded, so that e.g. `port: {port}` still renders an int and
+`name: "{name}"` a str. Resolved scalars are cached.
+"""
+
+import functools
+import os
+import re
+import string
+
+import yaml
+
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+BASE_DIR = os.path.join(os.path.dirname(__file__), "templates")
+
+_SENTINEL = "__devenv_field_{}__"
+_SENTINEL_RE = re.compile(r"__devenv_field_(\d+)__")
+_formatter = string.Formatter()
+
+
+class Field:
+    """A scalar whose source contains placeholders."""
+
+    __slots__ = ("parts", "fields")
+
+    def __init__(self, source: str, fields: list[tuple[str, str, str]]):
+        # Alternating literal source text and field indices.
+        self.parts = _SENTINEL_RE.split(source)
+        self.fields = fields
+
+    def render(self, kwargs: dict):
+        source = []
+        for i, part in enumerate(self.parts):
+            if i % 2 == 0:
+                source.append(part)
+                continue
+            name, conversion, spec = self.fields[int(part)]
+            value, _ = _formatter.get_field(name, (), kwargs)
+            value = _formatter.convert_field(value, conversion)
+            source.append(_formatter.format_field(value, spec))
+        return load_scalar("".join(source))
+
+
+@functools.lru_cache(maxsize=4096)
+def load_scalar(source: str):
+    return yaml.load(source, Loader=Loader)
+
+
+class Template:
+    """A manifest template, parsed once, see the module docstring."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(os.path.join(BASE_DIR, filename)) as fobj:
+            text = fobj.read()
+        fields, chunks = [], []
+        for literal, name, spec, conversion in _formatter.parse(text):
+            chunks.append(literal)
+            if name is not None:
+                chunks.append(_SENTINEL.format(len(fields)))
+                fields.append((name, conversion, spec))
+        self.source = "".join(chunks)
+        self.fields = fields
+        self.skeleton = self.compile(yaml.compose(self.source, Loader=Loader))
+
+    def compile(self, node):
+        if isinstance(node, yaml.MappingNode):
+            return {self.compile(key): self.compile(value) for key, value in node.value}
+        if isinstance(node, yaml.SequenceNode):
+            return [self.compile(item) for item in node.value]
+        start, end = node.start_mark.index, node.end_mark.index
+        if _SENTINEL_RE.search(node.value):
+            return Field(self.source[start:end], self.fields)
+        return load_scalar(self.source[start:end])
+
+    def render(self, **kwargs) -> dict:
+        """Return a new manifest, with placeholders filled in from `kwargs`."""
+        return fill(self.skeleton, kwargs)
+
+
+def fill(node, kwargs: dict):
+    if isinstance(node, dict):
+        return {fill(key, kwargs): fill(value, kwargs) for key, value in node.items()}
+    if isinstance(node, list):
+        return [fill(item, kwargs) for item in node]
+    if isinstance(node, Field):
+        return node.render(kwargs)
+    return node
+
+
+# Keyed by path relative to the operator directory, e.g. "templates/pvc.yaml".
+TEMPLATES = {
+    os.path.join("templates", filename): Template(filename)
+    for filename in sorted(os.listdir(BASE_DIR))
+    if filename.endswith(".yaml")
+}
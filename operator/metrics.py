@@ -0,0 +1,102 @@
+# Copyright © 2023 Dell Inc. or its subsidiaries. All Rights Reserved.
+
+"""Prometheus metrics of the operator.
+
+The metrics are served over HTTP on `METRICS_PORT` once the operator starts.
+"""
+
+import asyncio
+import functools
+import os
+import time
+
+import prometheus_client
+
+METRICS_PORT = int(os.getenv("DEVENV_METRICS_PORT", "9090"))
+
+HANDLER_DURATION = prometheus_client.Histogram(
+    "devenv_handler_duration_seconds",
+    "Time spent in DevEnv handlers.",
+    ["handler"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+HANDLER_RETRIES = prometheus_client.Counter(
+    "devenv_handler_retries_total",
+    "Number of times a DevEnv handler was retried after a failure.",
+    ["handler"],
+)
+HANDLERS_IN_PROGRESS = prometheus_client.Gauge(
+    "devenv_handlers_in_progress",
+    "Number of DevEnv handler invocations in progress.",
+)
+API_DURATION = prometheus_client.Histogram(
+    "devenv_api_request_duration_seconds",
+    "Latency of requests to the Kubernetes API server.",
+    ["verb", "resource"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+API_TIMEOUTS = prometheus_client.Counter(
+    "devenv_api_timeouts_total",
+    "Number of requests to the Kubernetes API server that timed out.",
+    ["verb", "resource"],
+)
+API_QUEUED = prometheus_client.Gauge(
+    "devenv_api_queued_requests",
+    "Number of requests to the Kubernetes API server waiting for the rate limit.",
+    ["priority"],
+)
+WORKLOAD_APPLIES = prometheus_client.Counter(
+    "devenv_workload_applies_total",
+    "Number of target workload applies, by whether they were issued or skipped.",
+    ["result"],
+)
+DRIFT_REPAIRS = prometheus_client.Counter(
+    "devenv_drift_repairs_total",
+    "Number of target workloads re-applied after drifting from their DevEnv.",
+)
+POOL_CLAIMS = prometheus_client.Counter(
+    "devenv_pool_claims_total",
+    "Number of new DevEnvs with a pool, by whether they claimed an environment.",
+    ["result"],
+)
+
+
+def instrument(func):
+    """Record the duration and retries of a kopf handler."""
+    handler = func.__name__
+
+    def record(retry):
+        if retry:
+            HANDLER_RETRIES.labels(handler).inc()
+        HANDLERS_IN_PROGRESS.inc()
+        return time.monotonic()
+
+    def done(started):
+        HANDLERS_IN_PROGRESS.dec()
+        HANDLER_DURATION.labels(handler).observe(time.monotonic() - started)
+
+    if asyncio.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = record(kwargs.get("retry"))
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                done(started)
+
+    else:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = record(kwargs.get("retry"))
+            try:
+                return func(*args, **kwargs)
+            finally:
+                done(started)
+
+    return wrapper
+
+
+def start_server() -> None:
+    prometheus_client.start_http_server(METRICS_PORT)
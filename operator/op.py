@@ -1,26 +1,222 @@
 # Copyright © 2023 Dell Inc. or its subsidiaries. All Rights Reserved.
 
+import asyncio
 import base64
+import contextlib
+import datetime
 import functools
+import hashlib
+import json
+import logging
 import os
+import random
 import shlex
-import subprocess
+import string
+import time
 from copy import deepcopy
 
 import kopf
+import kubeapi
+import manifests
+import metrics
 import yaml
 
-BASE_DIR = os.path.dirname(__file__)
+MAX_CONCURRENT_TARGETS = int(os.getenv("DEVENV_MAX_CONCURRENT_TARGETS", "8"))
+RETRY_DELAY = 10
+# Attempts to reconcile a target workload that keeps changing concurrently.
+CONFLICT_RETRIES = 3
+# Seconds to wait for more events of a DevEnv before handling its latest state.
+BATCH_WINDOW = float(os.getenv("DEVENV_BATCH_WINDOW", "0.5"))
+# Seconds to wait for the pods of target workloads to be ready after a change,
+# and to re-check the index for them in case a change notification was missed.
+ROLLOUT_TIMEOUT = float(os.getenv("DEVENV_ROLLOUT_TIMEOUT", "300"))
+ROLLOUT_RECHECK = 5
+# Attempts to wait for the pods of target workloads, before giving up until the
+# DevEnv changes again, e.g. if they crashloop.
+ROLLOUT_ATTEMPTS = int(os.getenv("DEVENV_ROLLOUT_ATTEMPTS", "3"))
+# Seconds between checks of DevEnvs for inactivity, see `hibernate_idle`.
+HIBERNATE_INTERVAL = 60
+# Seconds between checks of the target workloads of every DevEnv for drift,
+# see `repair_drift`. 0 disables them.
+DRIFT_INTERVAL = float(os.getenv("DEVENV_DRIFT_INTERVAL", "300"))
+# Maximum number of DevEnvs whose drifted targets are repaired at a time.
+DRIFT_CONCURRENCY = int(os.getenv("DEVENV_DRIFT_CONCURRENCY", "2"))
+# DevEnvs are split between `SHARDS` operator deployments, this one handles
+# the DevEnvs of `SHARD`, see `is_own`. The replicas of a shard elect the one
+# that's active through the kopf peering object `PEERING`, if set.
+SHARDS = int(os.getenv("DEVENV_SHARDS", "1"))
+SHARD = int(os.getenv("DEVENV_SHARD", "0"))
+PEERING = os.getenv("DEVENV_PEERING", "")
+# Seconds between checks of every pool for missing environments.
+POOL_INTERVAL = float(os.getenv("DEVENV_POOL_INTERVAL", "10"))
 
+# Annotation of debugged workloads with the original entrypoint and probes of
+# the debugged container.
+DEBUG_ORIGINAL = "dell.com/devenv-debug-original"
+DEBUG_FIELDS = ("command", "args", "livenessProbe", "readinessProbe", "startupProbe")
+# Annotation of mounted StatefulSets with the partition to restore on unmount.
+ORIGINAL_PARTITION = "dell.com/devenv-original-partition"
 
-@kopf.on.create("dell.com", "v1", "devenvs")
-@kopf.on.update("dell.com", "v1", "devenvs", field="spec")
-def create_update_dev_env(name, spec, namespace, logger, **kwargs):
+# Label of the PVC and Job of a shared dependency layer, see
+# `dependency_layer`.
+DEPS_LABEL = "dell.com/devenv-deps"
+# Marks a populated dependency layer, so that it's never populated twice.
+DEPS_POPULATED = ".devenv-populated"
+# Fields of DevEnvs that the name of their dependency layer is made of.
+LAYER_FIELDS = (("dependencies",), ("image",), ("storageClass",))
+
+# Annotation of DevEnvs with the time of the last sync or SSH session.
+LAST_ACTIVITY = "dell.com/devenv-last-activity"
+
+# Labels of the unclaimed environments of a pool, with the name of the pool
+# and the key of the DevEnvs that can claim them, see `pool_key`.
+POOL_LABEL = "dell.com/devenv-pool"
+POOL_KEY_LABEL = "dell.com/devenv-pool-key"
+# Annotation of DevEnvs with the environment they claimed from a pool.
+POOL_ENVIRONMENT = "dell.com/devenv-environment"
+# Spec fields that pooled environments are created with, see `pool_key`.
+POOL_FIELDS = ("image", "pvcSize", "storageClass", "accessMode")
+# Spec of pooled environments, other than the fields of their pool. Nobody
+# can log in until they're claimed.
+POOL_ENVIRONMENT_SPEC = {
+    "authorizedKeys": [],
+    "mounts": [],
+    "reloadSignal": "TERM",
+    "reloadCmd": "",
+    "postMountPodCmd": "",
+}
+# Kinds of the objects of an environment, see `environment_manifests`.
+ENVIRONMENT_KINDS = (
+    "service",
+    "deployment",
+    "statefulset",
+    "rolebinding",
+    "role",
+    "serviceaccount",
+    "persistentvolumeclaim",
+)
+
+# Paths of the code volume and of its local mirror, in the containers that
+# keep the mirror in sync, see `add_cache`.
+CACHE_SOURCE = "/devenv/code"
+CACHE_TARGET = "/devenv/cache"
+# The state of `sync.py`, e.g. its chunk store, isn't mirrored.
+CACHE_SYNC = (
+    f"rsync -a --delete --exclude=/.devenv-sync {CACHE_SOURCE}/ {CACHE_TARGET}/"
+)
+# Fields of containers that the API server would otherwise default, which
+# would keep the hash of a cached target from ever matching, see
+# `rollout_hash`. The pull policy is set by `add_cache`.
+CONTAINER_DEFAULTS = {
+    "resources": {},
+    "terminationMessagePath": "/dev/termination-log",
+    "terminationMessagePolicy": "File",
+}
+
+# Live fields that clones of workloads don't inherit.
+CLONE_DROPPED_ANNOTATIONS = (
+    "deployment.kubernetes.io/revision",
+    kubeapi.LAST_APPLIED,
+    DEBUG_ORIGINAL,
+    ORIGINAL_PARTITION,
+)
+CLONE_DROPPED_METADATA = (
+    "creationTimestamp",
+    "generation",
+    "managedFields",
+    "resourceVersion",
+    "uid",
+)
+
+
+@kopf.on.startup()
+def configure(settings: kopf.OperatorSettings, logger, **kwargs):
+    """Configure the operator and start serving metrics.
+
+    kopf queues the events of every DevEnv and handles them one at a time, so
+    that `create_update_dev_env` always runs before `update_mounts` for the
+    same change. Events that arrive within the batch window, or while a
+    change is being handled, are coalesced so that only the latest spec of
+    a DevEnv gets applied.
+    """
+    del kwargs
+    settings.batching.batch_window = BATCH_WINDOW
+    if PEERING:
+        # Only the replica with the highest priority is active, the rest take
+        # over once its peering entry expires, e.g. if its node goes down.
+        settings.peering.name = PEERING
+        settings.peering.clusterwide = True
+        settings.peering.mandatory = True
+        settings.peering.priority = random.randrange(2**31)
+        logger.info(
+            "Peering as %s with priority %d.", PEERING, settings.peering.priority
+        )
+    if SHARD:
+        # Every shard watches every DevEnv, and kopf removes its finalizer from
+        # those it has no handlers for, so shards must not share it, nor the
+        # state of the DevEnvs they handle. The first shard keeps kopf's
+        # defaults, so that an operator without shards can be split.
+        settings.persistence.finalizer = f"dell.com/devenv-shard-{SHARD}"
+        settings.persistence.progress_storage = kopf.SmartProgressStorage(
+            name=f"kopf-shard-{SHARD}", prefix=f"shard-{SHARD}.kopf.zalando.org"
+        )
+        settings.persistence.diffbase_storage = kopf.AnnotationsDiffBaseStorage(
+            key=f"last-handled-configuration-shard-{SHARD}"
+        )
+    if SHARDS > 1:
+        logger.info("Handling the DevEnvs of shard %d of %d.", SHARD, SHARDS)
+    logger.info("Serving metrics on port %d.", metrics.METRICS_PORT)
+    metrics.start_server()
+
+
+def is_own(namespace, name, **kwargs) -> bool:
+    """Whether this operator handles the DevEnv, see `SHARD`.
+
+    The shard of a DevEnv is picked by rendezvous hashing, so that when the
+    number of shards changes, only the DevEnvs of added or removed shards move.
+    Shards keep their own state of a DevEnv, see `configure`, so a DevEnv
+    that moves is handled like a new one by its new shard, which is
+    idempotent, and its previous shard removes its finalizer. The workloads
+    index isn't sharded, since targets are shared by DevEnvs.
+    """
+    del kwargs
+    return SHARDS == 1 or shard_of(namespace, name) == SHARD
+
+
+def shard_of(namespace: str, name: str) -> int:
+    return max(
+        range(SHARDS),
+        key=lambda shard: hashlib.sha256(
+            f"{shard}/{namespace}/{name}".encode()
+        ).digest(),
+    )
+
+
+@kopf.on.create("dell.com", "v1", "devenvs", when=is_own)
+@kopf.on.update("dell.com", "v1", "devenvs", field="spec", when=is_own)
+@metrics.instrument
+def create_update_dev_env(
+    name,
+    spec,
+    namespace,
+    meta,
+    logger,
+    patch,
+    pools,
+    status,
+    reason=None,
+    retry=0,
+    diff=(),
+    **kwargs,
+):
     """This handler will idempotently create/update the dev environment.
 
     It will be called when a DevEnv CRD is created or when its `spec` field is updated.
     To achieve a minimal idempotent implementation, we are just interpolating the
-    manifest templates and applying using `kubectl apply -f -`.
+    manifest templates and server-side applying them as a single batch.
+
+    A new DevEnv claims a running environment from a pool of its namespace if
+    there's one, see `claim_environment`, instead of waiting for a new one.
     """
     logger.info("Will idempotently create/update the dev environment.")
     del kwargs
@@ -28,206 +224,1133 @@ def create_update_dev_env(name, spec, namespace, logger, **kwargs):
     # Parse configuration options.
     image = spec["image"]
     kind = spec.get("kind", "deployment").capitalize()
-    ssh_keys = spec["authorizedKeys"]
-    pvc_size = spec["pvcSize"]
     base_domain = spec["baseDomain"]
     excluded_paths = spec["excludedPaths"]
-    mounts = spec["mounts"]
-    reload_signal = spec["reloadSignal"]
-    reload_cmd = spec["reloadCmd"]
-    post_mount_pod_cmd = spec["postMountPodCmd"]
+    storage_class = spec["storageClass"]
+    dependencies = spec.get("dependencies")
+    layer = dependency_layer(spec)
+    hibernated = spec.get("hibernated", False)
+    environment = environment_name(namespace, name, meta)
+    # Only a new DevEnv claims one, not one that moved to another shard.
+    new = reason == "create" and not retry and "create_update_dev_env" not in status
+    if new and environment == name:
+        environment = claim_environment(namespace, name, spec, pools, logger) or name
+
+    # Interpolate all templates and apply idempotently.
+    resources = environment_manifests(environment, spec, logger, devenv=name)
+    kopf.adopt(resources)
+    if layer:
+        # Shared with other DevEnvs, so not owned by this one.
+        resources += dependency_layer_manifests(
+            layer,
+            dependencies,
+            image=image,
+            storage_class=storage_class,
+            logger=logger,
+        )
+    with kubeapi.priority(change_priority(diff)):
+        kubectl_apply(namespace=namespace, manifest=resources, logger=logger)
+    if any(field[:1] in LAYER_FIELDS for _, field, _, _ in diff):
+        collect_dependency_layers(namespace=namespace, logger=logger)
+    if not hibernated and any(field == ("hibernated",) for _, field, _, _ in diff):
+        # Resumed, don't let it hibernate again before it's used.
+        logger.info("Resumed the dev environment.")
+        patch.meta.setdefault("annotations", {})[LAST_ACTIVITY] = utc_now()
+
+    # Prepare status information to be stored on the DevEnv CRD instance.
+    ssh_uri = f"docker@{name}.{base_domain}"
+    base_repo_path = ""
+    exclude_args = " ".join(f"--exclude={exc}" for exc in excluded_paths)
+    cmd = f"echo 'Starting rsync' && rsync -e 'ssh -o StrictHostKeyChecking=no' -rlptzv --progress {exclude_args} `pwd`/{base_repo_path} {ssh_uri}:/home/docker/code && echo Reloading services && ssh {ssh_uri} -- './scripts/reload.sh' && echo Done"  # NOQA: E501
+    # Resumes a hibernated environment, and waits for it and its clones.
+    resume = f'kubectl -n {namespace} patch devenv {name} --type=merge -p \'{{"spec":{{"hibernated":false}}}}\' && kubectl -n {namespace} rollout status {kind.lower()}/{environment} && kubectl -n {namespace} wait devenv {name} --for=condition=Ready'  # NOQA: E501
+    # Long-running alternative to `cmd`, that only transfers changed files. It
+    # resumes the environment first if it's hibernated, and on reconnects.
+    sync_excludes = " ".join(shlex.quote(f"--exclude={exc}") for exc in excluded_paths)
+    sync = f"{{ [ \"$(kubectl -n {namespace} get devenv {name} -o jsonpath='{{.spec.hibernated}}')\" != true ] || {{ {resume}; }}; }} && ssh -o StrictHostKeyChecking=no {ssh_uri} cat scripts/sync.py | python3 - watch --remote {ssh_uri} --devenv {namespace}/{name} {sync_excludes} ."  # NOQA: E501
+    return {
+        "ssh": ssh_uri,
+        "cmd": cmd,
+        "sync": sync,
+        "resume": resume,
+        "dependencies": layer,
+    }
+
 
-    # Interpolate all templates and apply idempotently using kubectl apply -f -
+def environment_manifests(name: str, spec: dict, logger, devenv: str) -> list[dict]:
+    """The objects of the environment `name`, for the DevEnv `devenv`.
+
+    They're named after the DevEnv, unless it claimed them from a pool, see
+    `environment_name`.
+    """
+    image = spec["image"]
+    dependencies = spec.get("dependencies")
+    layer = dependency_layer(spec)
     _t = functools.partial(template_yaml, logger=logger, name=name)
-    resources = [
+    resource = _t(
+        "templates/resource.yaml",
+        image=image,
+        image_pull_policy=image_pull_policy(image),
+        ssh_keys="\n".join(spec["authorizedKeys"]),
+        mounts=base64.b64encode(
+            yaml.dump(spec["mounts"], Dumper=manifests.Dumper).encode()
+        ).decode(),
+        devenv=devenv,
+        reload_signal=spec["reloadSignal"],
+        reload_cmd=spec["reloadCmd"],
+        post_mount_pod_cmd=spec["postMountPodCmd"],
+        cache_container=f"{devenv}-cache-sync" if spec.get("cache") else "",
+        kind=spec.get("kind", "deployment").capitalize(),
+        replicas=0 if spec.get("hibernated", False) else 1,
+    )
+    if layer:
+        add_mount(
+            manifest=resource,
+            volume_name="deps",
+            pvc_name=layer,
+            mount_path=dependencies["mountPath"],
+            read_only=True,
+        )
+    return [
         _t("templates/service-account.yaml"),
         _t("templates/role.yaml"),
         _t("templates/role-binding.yaml"),
         _t(
             "templates/pvc.yaml",
-            size=pvc_size,
-            access_mode="ReadWriteMany",
-            storage_class="efs",
-        ),
-        _t(
-            "templates/resource.yaml",
-            image=image,
-            ssh_keys="\n".join(ssh_keys),
-            mounts=base64.b64encode(yaml.safe_dump(mounts).encode()).decode(),
-            reload_signal=reload_signal,
-            reload_cmd=reload_cmd,
-            post_mount_pod_cmd=post_mount_pod_cmd,
-            kind=kind,
+            size=spec["pvcSize"],
+            access_mode=spec["accessMode"],
+            storage_class=spec["storageClass"],
         ),
-        _t("templates/svc.yaml", base_domain=base_domain),
+        resource,
+        _t("templates/svc.yaml", devenv=devenv, base_domain=spec["baseDomain"]),
     ]
-    kopf.adopt(resources)
-    kubectl_apply(namespace=namespace, manifest=resources, logger=logger)
 
-    # Prepare status information to be stored on the DevEnv CRD instance.
-    ssh_uri = f"docker@{name}.{base_domain}"
-    base_repo_path = ""
-    exclude_args = " ".join(f"--exclude={exc}" for exc in excluded_paths)
-    cmd = f"echo 'Starting rsync' && rsync -e 'ssh -o StrictHostKeyChecking=no' -rlptzv --progress {exclude_args} `pwd`/{base_repo_path} {ssh_uri}:/home/docker/code && echo Reloading services && ssh {ssh_uri} -- './scripts/reload.sh' && echo Done"  # NOQA: E501
-    return {"ssh": ssh_uri, "cmd": cmd}
 
+@kopf.on.field(
+    "dell.com",
+    "v1",
+    "devenvs",
+    field="spec.mountsEnabled",
+    param=kubeapi.INTERACTIVE,
+    when=is_own,
+)
+@kopf.on.field(
+    "dell.com",
+    "v1",
+    "devenvs",
+    field="spec.debug",
+    param=kubeapi.INTERACTIVE,
+    when=is_own,
+)
+@kopf.on.field(
+    "dell.com",
+    "v1",
+    "devenvs",
+    field="spec.hibernated",
+    param=kubeapi.INTERACTIVE,
+    when=is_own,
+)
+@kopf.on.field(
+    "dell.com",
+    "v1",
+    "devenvs",
+    field="spec.mounts",
+    param=kubeapi.BACKGROUND,
+    when=is_own,
+)
+@metrics.instrument
+async def update_mounts(
+    name,
+    spec,
+    namespace,
+    meta,
+    logger,
+    workloads,
+    patch,
+    param=kubeapi.BACKGROUND,
+    retry=0,
+    **kwargs,
+):
+    """This handler will idempotently update the volume mounts.
+
+    Target workloads are reconciled concurrently, see `reconcile_targets`.
+    Those whose pod template would not change are not re-applied. The number
+    of applied and skipped workloads is stored in the status. Toggling
+    `mountsEnabled`, `debug` or `hibernated` is interactive, so its API
+    requests take priority.
 
-@kopf.on.field("dell.com", "v1", "devenvs", field="spec.mountsEnabled")
-@kopf.on.field("dell.com", "v1", "devenvs", field="spec.mounts")
-def update_mounts(name, spec, namespace, logger, **kwargs):
-    """This handler will idempotently update the volume mounts."""
+    The handler only completes once the pods of all target workloads are
+    updated and ready, see `wait_for_rollouts`. Their progress is stored in
+    `status.targets`, along with a `Ready` condition, so that clients can
+    wait for it, e.g. with `kubectl wait --for=condition=Ready`. After
+    `ROLLOUT_ATTEMPTS` timeouts, the condition is failed and the handler isn't
+    retried anymore.
+    """
     del kwargs
     logger.info("Will idempotently update volume mounts.")
-    for (
-        manifest,
-        mounted,
-        mount_path,
-        sub_path,
-        entrypoints,
-    ) in iter_mounts_and_manifests(namespace, spec["mounts"]):
-        m_kind, m_name = manifest["kind"], manifest["metadata"]["name"]
-
-        if spec["mountsEnabled"] and mounted:
-            if spec.get("mode") == "clone":
-                _t = functools.partial(template_yaml, logger=logger, name=name)
-                base_domain = spec["baseDomain"]
-                port = spec["port"]
-                manifest = clone_manifest(manifest=manifest, new_name_postfix=name)
-                svc_manifest = _t(
-                    "templates/svc-http.yaml",
-                    name=manifest["metadata"]["name"],
-                    devenv=name,
-                    base_domain=base_domain,
-                    port=port,
-                )
-                ing_manifest = _t(
-                    "templates/ing.yaml",
-                    name=manifest["metadata"]["name"],
-                    base_domain=base_domain,
-                    port=port,
-                    group_name=spec.get("group", "default"),
-                )
-                logger.info("Idempotently cloning %s:%s", m_kind, m_name)
-                kubectl_apply(namespace=namespace, manifest=svc_manifest, logger=logger)
-                kubectl_apply(namespace=namespace, manifest=ing_manifest, logger=logger)
-            else:
-                logger.info("Idempotently mounting volume to %s:%s", m_kind, m_name)
+    started = time.monotonic()
+    with kubeapi.priority(param):
+        results = await reconcile_targets(
+            update_mount_target,
+            iter_mounts_and_manifests(namespace, spec["mounts"], workloads),
+            logger=logger,
+            name=name,
+            environment=environment_name(namespace, name, meta),
+            spec=spec,
+            namespace=namespace,
+            workloads=workloads,
+        )
+        rollouts = [rollout for _, rollout in filter(None, results)]
+        results = [result for result, _ in filter(None, results)]
+        applied, skipped = results.count("applied"), results.count("skipped")
+        metrics.WORKLOAD_APPLIES.labels("applied").inc(applied)
+        metrics.WORKLOAD_APPLIES.labels("skipped").inc(skipped)
+        logger.info("Applied %d and skipped %d target workloads.", applied, skipped)
+
+        progress = await wait_for_rollouts(workloads, namespace, rollouts, started, 0)
+        if not all(target["ready"] for target in progress):
+            logger.info("Waiting for target workloads to be ready.")
+            condition = ready_condition(False, "RollingOut", "Pods are being updated.")
+            await asyncio.to_thread(
+                kubeapi.patch,
+                namespace=namespace,
+                kind="devenv",
+                name=name,
+                body={"status": {"conditions": [condition]}},
+            )
+            progress = await wait_for_rollouts(
+                workloads, namespace, rollouts, started, ROLLOUT_TIMEOUT
+            )
+    patch.status["targets"] = progress
+    for target in progress:
+        if target.get("restartRequired"):
+            logger.warning(
+                "Pods of %s:%s only get updated when restarted.",
+                target["kind"],
+                target["name"],
+            )
+    pending = [target["name"] for target in progress if not target["ready"]]
+    if pending:
+        message = f"Pods of {', '.join(pending)} aren't ready."
+        if retry + 1 >= ROLLOUT_ATTEMPTS:
+            patch.status["conditions"] = [ready_condition(False, "Failed", message)]
+            raise kopf.PermanentError(message)
+        patch.status["conditions"] = [ready_condition(False, "Timeout", message)]
+        raise kopf.TemporaryError(message, delay=RETRY_DELAY)
+    patch.status["conditions"] = [ready_condition(True, "Ready", "Pods are ready.")]
+    return {"applied": applied, "skipped": skipped}
+
+
+def update_mount_target(
+    manifest,
+    mounted,
+    mount_path,
+    sub_path,
+    entrypoints,
+    partition,
+    dependencies_path,
+    *,
+    name,
+    environment,
+    spec,
+    namespace,
+    workloads,
+    logger,
+    drift=False,
+):
+    """Mount or unmount the code volume to a single target workload.
+
+    Returns "applied" or "skipped" depending on whether the workload had to
+    be updated, along with the rollout to wait for, see `wait_for_rollouts`.
+    Returns None if a clone was removed or there was nothing to do. With
+    `drift`, nothing is applied unless the workload itself drifted, not even
+    the service and ingress of a clone, see `repair_drift`.
+    """
+    m_kind, m_name = manifest["kind"], manifest["metadata"]["name"]
+    debug = spec.get("debug")
+    if debug and not debug["labels"].items() <= labels_of(manifest).items():
+        debug = None
+
+    if spec["mountsEnabled"] and mounted:
+        if spec.get("mode") == "clone":
+            _t = functools.partial(template_yaml, logger=logger, name=name)
+            base_domain = spec["baseDomain"]
+            port = spec["port"]
+            manifest = clone_manifest(manifest=manifest, new_name_postfix=name)
+            if spec.get("hibernated"):
+                manifest["spec"]["replicas"] = 0
+            live_hash = next(
+                (
+                    clone_hash(clone)
+                    for clone in find_workloads(
+                        workloads, namespace, m_kind, {"devenv": name}, copy=False
+                    )
+                    if clone["metadata"]["name"] == manifest["metadata"]["name"]
+                ),
+                None,
+            )
+            svc_manifest = _t(
+                "templates/svc-http.yaml",
+                name=manifest["metadata"]["name"],
+                devenv=name,
+                base_domain=base_domain,
+                port=port,
+            )
+            ing_manifest = _t(
+                "templates/ing.yaml",
+                name=manifest["metadata"]["name"],
+                base_domain=base_domain,
+                port=port,
+                group_name=spec.get("group", "default"),
+            )
+            logger.info("Idempotently cloning %s:%s", m_kind, m_name)
+            resources = [svc_manifest, ing_manifest]
+        else:
+            live_hash = rollout_hash(manifest)
+            manifest = with_template_copy(manifest)
+            restore_debug(manifest=manifest)
+            logger.info("Idempotently mounting volume to %s:%s", m_kind, m_name)
+            resources = []
+        if spec.get("cache"):
+            add_cache(
+                manifest=manifest,
+                volume_name=name,
+                pvc_name=environment,
+                mount_path=mount_path,
+                sub_path=sub_path,
+                cache=spec["cache"],
+                image=spec["image"],
+            )
+        else:
+            remove_cache(manifest=manifest, volume_name=name)
             add_mount(
                 manifest=manifest,
                 volume_name=name,
-                pvc_name=name,
+                pvc_name=environment,
                 mount_path=mount_path,
                 sub_path=sub_path,
             )
-            update_entrypoints(manifest=manifest, entrypoints=entrypoints)
-            kubectl_apply(namespace=namespace, manifest=manifest, logger=logger)
+        layer = dependency_layer(spec)
+        if layer and dependencies_path:
+            add_mount(
+                manifest=manifest,
+                volume_name=f"{name}-deps",
+                pvc_name=layer,
+                mount_path=dependencies_path,
+                read_only=True,
+            )
         else:
-            if spec.get("mode") == "modify":
-                remove_mount(manifest=manifest, volume_name=name)
-                restore_entrypoints(manifest=manifest, entrypoints=entrypoints)
-                logger.info("Idempotently unmounting volume to %s:%s", m_kind, m_name)
-                kubectl_apply(namespace=namespace, manifest=manifest, logger=logger)
-            elif kubectl_get(namespace=namespace, kind=m_kind, labels={"devenv": name}):
-                resource_name = manifest["metadata"]["name"] + "-" + name
-                logger.info("Idempotently removing %s %s", m_kind, resource_name)
-                kubectl_delete(
-                    namespace=namespace, name=resource_name, kind=m_kind, logger=logger
-                )
-                kubectl_delete(
-                    namespace=namespace,
-                    name=resource_name,
-                    kind="service",
-                    logger=logger,
+            remove_mount(manifest=manifest, volume_name=f"{name}-deps")
+        update_entrypoints(manifest=manifest, entrypoints=entrypoints)
+        if debug:
+            logger.info("Debugging %s:%s", m_kind, manifest["metadata"]["name"])
+            update_debug(manifest=manifest, debug=debug)
+        if spec.get("mode") != "clone":
+            update_partition(manifest=manifest, partition=partition)
+        generation = 0
+        if spec.get("mode") == "clone":
+            new_hash = clone_hash(manifest)
+        else:
+            new_hash = rollout_hash(manifest)
+        if new_hash == live_hash:
+            if drift:
+                return "skipped", rollout_of(manifest, generation)
+            logger.info("%s:%s is up to date", m_kind, m_name)
+            result = "skipped"
+        else:
+            resources.append(manifest)
+            result = "applied"
+        if resources:
+            applied = kubectl_apply(
+                namespace=namespace, manifest=resources, logger=logger
+            )
+            if result == "applied":
+                generation = applied_generation(applied, manifest)
+        return result, rollout_of(manifest, generation)
+    elif spec.get("mode") == "modify":
+        live_hash = rollout_hash(manifest)
+        manifest = with_template_copy(manifest)
+        restore_debug(manifest=manifest)
+        remove_cache(manifest=manifest, volume_name=name)
+        remove_mount(manifest=manifest, volume_name=name)
+        remove_mount(manifest=manifest, volume_name=f"{name}-deps")
+        restore_entrypoints(manifest=manifest, entrypoints=entrypoints)
+        restore_partition(manifest=manifest)
+        if rollout_hash(manifest) == live_hash:
+            logger.info("%s:%s is already unmounted", m_kind, m_name)
+            return "skipped", rollout_of(manifest, 0)
+        logger.info("Idempotently unmounting volume to %s:%s", m_kind, m_name)
+        applied = kubectl_apply(namespace=namespace, manifest=manifest, logger=logger)
+        return "applied", rollout_of(manifest, applied_generation(applied, manifest))
+    elif any(
+        clone["metadata"]["name"] == manifest["metadata"]["name"] + "-" + name
+        for clone in find_workloads(
+            workloads, namespace, m_kind, {"devenv": name}, copy=False
+        )
+    ):
+        resource_name = manifest["metadata"]["name"] + "-" + name
+        logger.info("Idempotently removing %s %s", m_kind, resource_name)
+        kubectl_delete(
+            namespace=namespace, name=resource_name, kind=m_kind, logger=logger
+        )
+        kubectl_delete(
+            namespace=namespace,
+            name=resource_name,
+            kind="service",
+            logger=logger,
+        )
+        kubectl_delete(
+            namespace=namespace,
+            name=resource_name,
+            kind="ingress",
+            logger=logger,
+        )
+
+
+@kopf.on.delete("dell.com", "v1", "devenvs", when=is_own)
+@metrics.instrument
+async def cleanup_mounts(name, spec, namespace, logger, workloads, **kwargs):
+    del kwargs
+    logger.info("Clean up all volume mounts because dev env is being deleted.")
+    results = await reconcile_targets(
+        cleanup_mount_target,
+        iter_mounts_and_manifests(namespace, spec["mounts"], workloads),
+        logger=logger,
+        name=name,
+        namespace=namespace,
+    )
+    metrics.WORKLOAD_APPLIES.labels("applied").inc(results.count("applied"))
+    metrics.WORKLOAD_APPLIES.labels("skipped").inc(results.count("skipped"))
+    _claimed.pop((namespace, name), None)
+    if spec.get("dependencies"):
+        await asyncio.to_thread(
+            collect_dependency_layers,
+            namespace=namespace,
+            logger=logger,
+            deleted=name,
+        )
+
+
+def cleanup_mount_target(manifest, *args, name, namespace, logger):
+    del args
+    live_hash = rollout_hash(manifest)
+    manifest = with_template_copy(manifest)
+    restore_debug(manifest=manifest)
+    remove_cache(manifest=manifest, volume_name=name)
+    remove_mount(manifest=manifest, volume_name=name)
+    remove_mount(manifest=manifest, volume_name=f"{name}-deps")
+    restore_partition(manifest=manifest)
+    if rollout_hash(manifest) == live_hash:
+        return "skipped"
+    kubectl_apply(namespace=namespace, manifest=manifest, logger=logger)
+    return "applied"
+
+
+def dependency_layer(spec: dict) -> str | None:
+    """Name of the PVC and Job of the dependency layer of a DevEnv spec.
+
+    Layers are content addressed, so that DevEnvs with the same key share the
+    same layer, and a changed key gets a new one. The name covers everything
+    else the PVC and Job are made of too, since they can't be changed once
+    created.
+    """
+    dependencies = spec.get("dependencies")
+    if not dependencies:
+        return None
+    content = json.dumps(
+        [
+            dependencies["key"],
+            dependencies["command"],
+            dependencies.get("image") or spec["image"],
+            dependencies.get("mountPath"),
+            dependencies.get("size"),
+            spec.get("storageClass"),
+        ],
+        separators=(",", ":"),
+    )
+    digest = hashlib.sha256(content.encode()).hexdigest()
+    return f"devenv-deps-{digest[:16]}"
+
+
+def dependency_layer_manifests(
+    layer: str, dependencies: dict, image: str, storage_class: str, logger
+) -> list[dict]:
+    """The PVC of a dependency layer and the Job that populates it."""
+    _t = functools.partial(template_yaml, logger=logger, name=layer)
+    # Shared by the pods of many DevEnvs, on any node.
+    pvc = _t(
+        "templates/pvc.yaml",
+        size=dependencies["size"],
+        access_mode="ReadWriteMany",
+        storage_class=storage_class,
+    )
+    pvc["metadata"]["labels"][DEPS_LABEL] = layer
+    # Don't populate the layer again, e.g. if the Job got garbage collected.
+    script = (
+        f"test -f {DEPS_POPULATED} || "
+        f"{{ {dependencies['command']}\n}} && touch {DEPS_POPULATED}"
+    )
+    job = _t(
+        "templates/deps-job.yaml",
+        image=dependencies.get("image") or image,
+        mount_path=dependencies["mountPath"],
+        script=json.dumps(script),
+    )
+    return [pvc, job]
+
+
+def collect_dependency_layers(namespace: str, logger, deleted: str = "") -> None:
+    """Delete the dependency layers that no DevEnv of the namespace uses.
+
+    The DevEnv named `deleted` is being deleted and doesn't count. PVCs that
+    are still mounted by pods are only removed once they're not.
+    """
+    used = {
+        dependency_layer(devenv["spec"])
+        for devenv in kubeapi.list_(namespace=namespace, kind="devenv", labels={})
+        if devenv["metadata"]["name"] != deleted
+    }
+    for kind in ("job", "persistentvolumeclaim"):
+        for obj in kubeapi.list_(namespace=namespace, kind=kind, labels={}):
+            layer = obj["metadata"].get("labels", {}).get(DEPS_LABEL)
+            if layer is None or layer in used:
+                continue
+            logger.info("Deleting unused dependency layer %s:%s", kind, layer)
+            kubectl_delete(
+                namespace=namespace,
+                name=obj["metadata"]["name"],
+                kind=kind,
+                logger=logger,
+            )
+
+
+def can_drift(spec, **kwargs) -> bool:
+    return (
+        DRIFT_INTERVAL > 0
+        and spec["mountsEnabled"]
+        and bool(spec["mounts"])
+        and is_own(**kwargs)
+    )
+
+
+def drift_delay(**kwargs) -> float:
+    """Spread the drift checks of DevEnvs over `DRIFT_INTERVAL`."""
+    del kwargs
+    return random.uniform(0, DRIFT_INTERVAL)
+
+
+# Bounds the DevEnvs whose drifted targets are repaired at a time.
+_drift_repairs = asyncio.Semaphore(DRIFT_CONCURRENCY)
+
+
+@kopf.timer(
+    "dell.com",
+    "v1",
+    "devenvs",
+    interval=max(DRIFT_INTERVAL, 1),
+    initial_delay=drift_delay,
+    when=can_drift,
+)
+async def repair_drift(name, spec, namespace, meta, logger, workloads, **kwargs):
+    """Re-apply the target workloads that drifted from the desired mounts.
+
+    E.g. a Helm upgrade of a target release drops the code volume or the
+    entrypoints. Targets are checked against the workloads index, so only
+    drifted ones cost any API requests, which are of background priority and
+    share the rate limit of the operator, see `kubeapi.priority`.
+    """
+    del kwargs
+    async with _drift_repairs:
+        with kubeapi.priority(kubeapi.BACKGROUND):
+            results = await reconcile_targets(
+                update_mount_target,
+                iter_mounts_and_manifests(namespace, spec["mounts"], workloads),
+                logger=logger,
+                name=name,
+                environment=environment_name(namespace, name, meta),
+                spec=spec,
+                namespace=namespace,
+                workloads=workloads,
+                drift=True,
+            )
+    repaired = [result for result, _ in filter(None, results)].count("applied")
+    if repaired:
+        logger.warning("Repaired %d drifted target workloads.", repaired)
+        metrics.DRIFT_REPAIRS.inc(repaired)
+
+
+def rollout_of(manifest: dict, generation: int) -> tuple:
+    """The rollout of a workload to wait for, once it reaches `generation`."""
+    metadata = manifest["metadata"]
+    return manifest["kind"], metadata["name"], labels_of(manifest), generation
+
+
+def applied_generation(applied: list[dict], manifest: dict) -> int:
+    """The generation of `manifest` among the objects that were just applied."""
+    return next(
+        obj["metadata"].get("generation", 0)
+        for obj in applied
+        if obj["kind"] == manifest["kind"]
+        and obj["metadata"]["name"] == manifest["metadata"]["name"]
+    )
+
+
+# Notified on every change of a workload, see `workload_event`.
+_workloads_changed = asyncio.Condition()
+
+
+@kopf.on.event("apps", "v1", "deployments")
+@kopf.on.event("apps", "v1", "statefulsets")
+async def workload_event(**kwargs):
+    """Wake up the handlers that wait for rollouts, see `wait_for_rollouts`.
+
+    kopf updates its indices before calling event handlers, so the index
+    already has the change by the time they check it.
+    """
+    del kwargs
+    async with _workloads_changed:
+        _workloads_changed.notify_all()
+
+
+async def wait_for_rollouts(
+    index, namespace: str, rollouts: list[tuple], started: float, timeout: float
+) -> list[dict]:
+    """Wait for the pods of target workloads to be updated and ready.
+
+    Rollouts are followed through the workloads index, without polling the
+    API server. Every change of a workload wakes this up, and the index is
+    also re-checked every `ROLLOUT_RECHECK` seconds in case a notification
+    was missed. Returns the progress of every rollout, once they're all
+    ready or after `timeout` seconds.
+    """
+    progress = {}
+    deadline = time.monotonic() + timeout
+    async with _workloads_changed:
+        while True:
+            for kind, name, labels, generation in rollouts:
+                if progress.get((kind, name), {}).get("ready"):
+                    continue
+                manifest = next(
+                    (
+                        workload
+                        for workload in find_workloads(
+                            index, namespace, kind, labels, copy=False
+                        )
+                        if workload["metadata"]["name"] == name
+                    ),
+                    None,
                 )
-                kubectl_delete(
-                    namespace=namespace,
-                    name=resource_name,
-                    kind="ingress",
-                    logger=logger,
+                target = rollout_progress(kind, name, manifest, generation)
+                if target["ready"]:
+                    target["timeToReady"] = round(time.monotonic() - started, 1)
+                progress[(kind, name)] = target
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or all(t["ready"] for t in progress.values()):
+                return list(progress.values())
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    _workloads_changed.wait(), min(remaining, ROLLOUT_RECHECK)
                 )
 
 
-@kopf.on.delete("dell.com", "v1", "devenvs")
-def cleanup_mounts(name, spec, namespace, logger, **kwargs):
+def rollout_progress(kind: str, name: str, manifest: dict | None, generation: int):
+    """Rollout progress of a workload, as of its last known state.
+
+    Pods of StatefulSets with the `OnDelete` strategy and of paused Deployments
+    are never replaced by their controller. Those are rolled out once their
+    controller observed the change, and flagged with `restartRequired`.
+    """
+    progress = {"kind": kind, "name": name, "ready": False}
+    if manifest is None:
+        return progress
+    spec, status = manifest["spec"], manifest.get("status", {})
+    replicas = spec.get("replicas", 1)
+    rolling_update = spec.get("updateStrategy", {}).get("rollingUpdate", {})
+    partition = rolling_update.get("partition", 0)
+    updated = status.get("updatedReplicas", 0)
+    ready = status.get("readyReplicas", 0)
+    live_generation = manifest["metadata"].get("generation", 0)
+    progress["replicas"] = replicas
+    progress["updatedReplicas"] = updated
+    progress["readyReplicas"] = ready
+    observed = (
+        live_generation >= generation
+        and status.get("observedGeneration", 0) >= live_generation
+    )
+    update_type = spec.get("updateStrategy", {}).get("type")
+    if update_type == "OnDelete" or spec.get("paused"):
+        progress["restartRequired"] = updated < replicas
+        progress["ready"] = observed
+        return progress
+    progress["ready"] = (
+        observed
+        and updated >= replicas - partition
+        # Pods of the previous revision are gone.
+        and status.get("replicas", 0) == replicas
+        and ready >= replicas
+    )
+    return progress
+
+
+def ready_condition(ready: bool, reason: str, message: str) -> dict:
+    return {
+        "type": "Ready",
+        "status": str(ready),
+        "reason": reason,
+        "message": message,
+        "lastTransitionTime": utc_now(),
+    }
+
+
+def utc_now() -> str:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_time(value: str) -> datetime.datetime:
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(
+        tzinfo=datetime.timezone.utc
+    )
+
+
+def can_hibernate(spec, **kwargs) -> bool:
+    return (
+        bool(spec.get("hibernateAfter"))
+        and not spec.get("hibernated")
+        and is_own(**kwargs)
+    )
+
+
+@kopf.timer(
+    "dell.com", "v1", "devenvs", interval=HIBERNATE_INTERVAL, when=can_hibernate
+)
+def hibernate_idle(name, spec, meta, logger, patch, **kwargs):
+    """Hibernate the DevEnv once it's been idle for `hibernateAfter` minutes.
+
+    Activity is recorded on the DevEnv's `LAST_ACTIVITY` annotation by
+    `reload.py` on every sync, and by the environment itself while SSH
+    sessions are open or its clones serve HTTP requests, see `activity.sh`.
+    Hibernating scales the environment and its clones to zero, see
+    `create_update_dev_env` and `update_mounts`, until `hibernated` is unset
+    again. Nothing resumes the DevEnv on incoming requests though.
+    """
     del kwargs
-    logger.info("Clean up all volume mounts because dev env is being deleted.")
-    for manifest, _, _, _, _ in iter_mounts_and_manifests(namespace, spec["mounts"]):
-        remove_mount(manifest=manifest, volume_name=name)
-        kubectl_apply(namespace=namespace, manifest=manifest, logger=logger)
+    last_activity = meta.get("annotations", {}).get(
+        LAST_ACTIVITY, meta["creationTimestamp"]
+    )
+    idle = datetime.datetime.now(datetime.timezone.utc) - parse_time(last_activity)
+    if idle.total_seconds() < spec["hibernateAfter"] * 60:
+        return
+    logger.info("Hibernating %s, idle since %s.", name, last_activity)
+    patch.spec["hibernated"] = True
+
+
+# Environments claimed from pools, by namespace and name of the DevEnv, for
+# the handlers that run before its annotation is seen, see `environment_name`.
+_claimed = {}
+
+
+def environment_name(namespace: str, name: str, meta) -> str:
+    """Name of the objects of the DevEnv's environment, e.g. of its code PVC.
+
+    It's the name of the DevEnv, unless it claimed an environment from a pool.
+    """
+    claimed = meta.get("annotations", {}).get(POOL_ENVIRONMENT)
+    return claimed or _claimed.get((namespace, name), name)
+
+
+def pool_key(spec) -> str:
+    """Key of the DevEnvs that can claim the environments of a pool.
+
+    That's those with the same image, kind and PVC as the pool, which can't
+    change without restarting the environment or recreating its PVC.
+    """
+    fields = [spec.get("kind", "deployment")] + [spec[key] for key in POOL_FIELDS]
+    return hashlib.sha256(json.dumps(fields).encode()).hexdigest()[:16]
+
+
+@kopf.index("dell.com", "v1", "devenvpools")
+def pools(namespace, name, spec, **kwargs):
+    """Index pools by namespace and key, see `claim_environment`."""
+    del kwargs
+    return {(namespace, pool_key(spec)): name}
+
+
+def claim_environment(namespace: str, name: str, spec, pools, logger) -> str | None:
+    """Claim an unclaimed environment of a pool for the DevEnv, if any.
+
+    Its PVC is bound and its pod running already, so the DevEnv's objects
+    are applied over them, only restarting the pod with the DevEnv's keys and
+    mounts. The claim is recorded on the DevEnv right away, so that it's
+    never claimed again, see `environment_name`.
+    """
+    key = pool_key(spec)
+    if (namespace, key) not in pools:
+        return None
+    pvcs = kubeapi.list_(namespace, "persistentvolumeclaim", {POOL_KEY_LABEL: key})
+    for pvc in sorted(pvcs, key=pool_order):
+        if not take_environment(namespace, pvc):
+            continue
+        environment = pvc["metadata"]["name"]
+        _claimed[namespace, name] = environment
+        kubeapi.patch(
+            namespace,
+            "devenv",
+            name,
+            {"metadata": {"annotations": {POOL_ENVIRONMENT: environment}}},
+        )
+        logger.info("Claimed the pooled environment %s.", environment)
+        metrics.POOL_CLAIMS.labels("claimed").inc()
+        return environment
+    logger.info("No pooled environment left, creating a new one.")
+    metrics.POOL_CLAIMS.labels("empty").inc()
+    return None
+
+
+def take_environment(namespace: str, pvc: dict) -> bool:
+    """Remove an environment from its pool, unless it was taken meanwhile.
+
+    Its PVC is unlabeled with an optimistic lock, so that an environment is
+    never taken twice, by DevEnvs or by `refill_pool`. The rest of its
+    objects are unlabeled once the DevEnv's objects are applied over them.
+    """
+    metadata = pvc["metadata"]
+    body = {
+        "metadata": {
+            "resourceVersion": metadata["resourceVersion"],
+            "labels": {POOL_LABEL: None, POOL_KEY_LABEL: None},
+        }
+    }
+    try:
+        kubeapi.patch(namespace, "persistentvolumeclaim", metadata["name"], body)
+    except kubeapi.ApiError as exc:
+        if exc.status not in (404, 409):
+            raise
+        return False
+    return True
+
+
+def pool_order(pvc: dict) -> tuple:
+    """Bound PVCs first, the oldest of which likely have a running pod."""
+    bound = pvc.get("status", {}).get("phase") == "Bound"
+    return not bound, pvc["metadata"]["creationTimestamp"]
+
+
+@kopf.timer("dell.com", "v1", "devenvpools", interval=POOL_INTERVAL, when=is_own)
+def refill_pool(name, spec, status, namespace, logger, patch, **kwargs):
+    """Keep `size` unclaimed environments in the pool.
+
+    Environments are created like those of DevEnvs, but owned by the pool,
+    so that they're deleted along with it. Those that no longer match the
+    pool's spec, e.g. after its image changed, or exceed its size are
+    replaced or deleted.
+    """
+    del kwargs
+    key = pool_key(spec)
+    size = spec["size"]
+    pvcs = kubeapi.list_(namespace, "persistentvolumeclaim", {POOL_LABEL: name})
+    current = sorted(
+        (pvc for pvc in pvcs if pvc["metadata"]["labels"][POOL_KEY_LABEL] == key),
+        key=pool_order,
+    )
+    kept, removed = current[:size], current[size:]
+    removed += [pvc for pvc in pvcs if pvc["metadata"]["labels"][POOL_KEY_LABEL] != key]
+    with kubeapi.priority(kubeapi.BACKGROUND):
+        for pvc in removed:
+            if take_environment(namespace, pvc):
+                logger.info("Deleting pooled environment %s.", pvc["metadata"]["name"])
+                delete_environment(namespace, pvc["metadata"]["name"])
+        for _ in range(size - len(kept)):
+            suffix = "".join(
+                random.choices(string.ascii_lowercase + string.digits, k=5)
+            )
+            environment = f"{name}-{suffix}"
+            logger.info("Creating pooled environment %s.", environment)
+            resources = environment_manifests(
+                environment,
+                {**POOL_ENVIRONMENT_SPEC, **spec},
+                logger,
+                devenv=environment,
+            )
+            for resource in resources:
+                resource["metadata"]["labels"][POOL_LABEL] = name
+                resource["metadata"]["labels"][POOL_KEY_LABEL] = key
+            kopf.adopt(resources)
+            kubectl_apply(namespace=namespace, manifest=resources, logger=logger)
+    # Created environments aren't bound yet.
+    bound = sum(not pool_order(pvc)[0] for pvc in kept)
+    if (status.get("available"), status.get("bound")) != (size, bound):
+        patch.status["available"] = size
+        patch.status["bound"] = bound
+
+
+def delete_environment(namespace: str, name: str) -> None:
+    for kind in ENVIRONMENT_KINDS:
+        try:
+            kubeapi.delete(namespace, kind, name)
+        except kubeapi.ApiError as exc:
+            if exc.status != 404:
+                raise
+
+
+def change_priority(diff) -> int:
+    """API request priority of a spec change, see `kubeapi.priority`.
+
+    Only a change to `mountsEnabled`, `debug` or `hibernated` alone, e.g. by
+    `reload.sh` once code got synced for the first time, by `debug.py` or to
+    resume, is interactive.
+    """
+    interactive = {("mountsEnabled",), ("debug",), ("hibernated",)}
+    if diff and all(field[:1] in interactive for _, field, _, _ in diff):
+        return kubeapi.INTERACTIVE
+    return kubeapi.BACKGROUND
+
+
+async def reconcile_targets(func, targets, logger, **kwargs) -> list:
+    """Call `func` for every target tuple, in parallel, in worker threads.
+
+    At most `MAX_CONCURRENT_TARGETS` targets are reconciled at the same time.
+    A failing target doesn't affect the rest. Once all of them are done, a
+    temporary error is raised if any failed, so that kopf retries the handler.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_TARGETS)
+
+    async def reconcile(target):
+        async with semaphore:
+            return await asyncio.to_thread(
+                reconcile_target, func, target, logger=logger, **kwargs
+            )
+
+    targets = list(targets)
+    results = await asyncio.gather(*map(reconcile, targets), return_exceptions=True)
+    failed = 0
+    for target, result in zip(targets, results):
+        if isinstance(result, Exception):
+            failed += 1
+            kind, name = target[0]["kind"], target[0]["metadata"]["name"]
+            logger.error("Failed to reconcile %s:%s: %s", kind, name, result)
+    if failed:
+        raise kopf.TemporaryError(
+            f"Failed to reconcile {failed} of {len(targets)} target workloads.",
+            delay=RETRY_DELAY,
+        )
+    return results
+
+
+def reconcile_target(func, target, logger, **kwargs):
+    """Call `func` for a target tuple, again with the live workload on conflicts.
+
+    Target workloads are applied with the resourceVersion they were indexed
+    with, so that a stale manifest never overwrites concurrent changes, e.g.
+    of a Helm upgrade. The API server rejects it with 409 instead.
+    """
+    manifest, *options = target
+    for attempt in range(CONFLICT_RETRIES):
+        try:
+            return func(manifest, *options, logger=logger, **kwargs)
+        except kubeapi.ApiError as exc:
+            if exc.status != 409 or attempt == CONFLICT_RETRIES - 1:
+                raise
+        kind, name = manifest["kind"], manifest["metadata"]["name"]
+        logger.info("%s:%s changed concurrently, will retry.", kind, name)
+        manifest = kubeapi.get(namespace=kwargs["namespace"], kind=kind, name=name)
+
+
+@kopf.index("apps", "v1", "deployments")
+@kopf.index("apps", "v1", "statefulsets")
+def workloads(namespace, body, **kwargs):
+    """Index target workloads by namespace and by each of their labels.
+
+    kopf keeps this index up to date from a single watch stream, so that mount
+    reconciliation resolves label selectors from memory instead of listing the
+    workloads from the API server on every event. See `find_workloads`.
+    """
+    del kwargs
+    kind = body["kind"].lower()
+    manifest = {key: val for key, val in body.items() if key != "metadata"}
+    manifest["metadata"] = {
+        key: val for key, val in body["metadata"].items() if key != "managedFields"
+    }
+    annotations = manifest["metadata"].get("annotations", {})
+    if kubeapi.LAST_APPLIED in annotations:
+        manifest["metadata"]["annotations"] = {
+            key: val for key, val in annotations.items() if key != kubeapi.LAST_APPLIED
+        }
+    keys = [(kind, namespace)]
+    for key, val in manifest["metadata"].get("labels", {}).items():
+        keys.append((kind, namespace, key, val))
+    return {key: manifest for key in keys}
+
+
+def find_workloads(
+    index, namespace: str, kind: str, labels: dict[str, str], copy: bool = True
+):
+    """Return the indexed workloads that match all `labels`.
+
+    Unless `copy` is false, the returned manifests are copies that can be
+    safely mutated.
+    """
+    kind = kind.lower()
+    keys = [(kind, namespace, key, val) for key, val in labels.items()]
+    stores = [index.get(key, ()) for key in keys or [(kind, namespace)]]
+    return [
+        deepcopy(manifest) if copy else manifest
+        for manifest in min(stores, key=len)
+        if labels.items() <= manifest["metadata"].get("labels", {}).items()
+    ]
+
+
+def rollout_hash(manifest: dict) -> str:
+    """Canonical hash of a workload's pod template and StatefulSet partition."""
+    rollout = json.dumps(
+        [manifest["spec"]["template"], manifest["spec"].get("updateStrategy")],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(rollout.encode()).hexdigest()
+
+
+def clone_hash(manifest: dict) -> str:
+    """Like `rollout_hash`, but also covering replicas, which clones own."""
+    return f"{rollout_hash(manifest)}:{manifest['spec'].get('replicas')}"
+
+
+def image_pull_policy(image: str) -> str:
+    """Let nodes reuse cached images that are pinned by digest.
+
+    Tags are usually pushed again, e.g. `latest`, so they're pulled on every
+    start, like before. A digest always refers to the same image.
+    """
+    return "IfNotPresent" if "@" in image else "Always"
 
 
 def template_yaml(filename, logger, **kwargs):
     logger.debug(
         "Will load and interpolate template file %s with kwargs %s", filename, kwargs
     )
-    with open(os.path.join(BASE_DIR, filename)) as fobj:
-        template = fobj.read()
-    text = template.format(**kwargs)
-    data = yaml.safe_load(text)
-    logger.debug("%s data:\n%s", filename, yaml.safe_dump(data))
+    data = manifests.TEMPLATES[filename].render(**kwargs)
+    if logger.isEnabledFor(logging.DEBUG):
+        dump = yaml.dump(data, Dumper=manifests.Dumper)
+        logger.debug("%s data:\n%s", filename, dump)
     return data
 
 
 def clone_manifest(manifest, new_name_postfix):
-    new_manifest = deepcopy(manifest)
-    new_manifest["metadata"]["name"] += "-" + new_name_postfix
-    for key in [
-        "deployment.kubernetes.io/revision",
-        "kubectl.kubernetes.io/last-applied-configuration",
-    ]:
-        if key in new_manifest["metadata"]["annotations"]:
-            del new_manifest["metadata"]["annotations"][key]
-    for key in ["creationTimestamp", "generation", "resourceVersion", "uid"]:
-        if key in new_manifest["metadata"]:
-            del new_manifest["metadata"][key]
-    if "release" in new_manifest["metadata"]["labels"]:
-        del new_manifest["metadata"]["labels"]["release"]
-    new_manifest["spec"]["template"]["metadata"]["labels"] = {
-        "devenv": new_name_postfix
+    """Derive the clone of a workload as a projection of the live manifest.
+
+    Only the pod template spec is copied, since mounts and entrypoints are
+    added to it afterwards. Everything else the clone keeps is shared with
+    `manifest`, and fields owned by the API server are never copied.
+    """
+    metadata = manifest["metadata"]
+    annotations = {
+        key: val
+        for key, val in metadata.get("annotations", {}).items()
+        if key not in CLONE_DROPPED_ANNOTATIONS
+    }
+    spec = manifest["spec"]
+    template = spec["template"]
+    if "partition" in spec.get("updateStrategy", {}).get("rollingUpdate", {}):
+        # A partition would keep the single replica of a clone from updating.
+        # It's reset rather than dropped, since the API server defaults it to
+        # 0, and the clone's hash has to match the live clone.
+        spec = {
+            **spec,
+            "updateStrategy": {
+                **spec["updateStrategy"],
+                "rollingUpdate": {
+                    **spec["updateStrategy"]["rollingUpdate"],
+                    "partition": 0,
+                },
+            },
+        }
+    return {
+        **{key: val for key, val in manifest.items() if key not in ("spec", "status")},
+        "metadata": {
+            **{
+                key: val
+                for key, val in metadata.items()
+                if key not in CLONE_DROPPED_METADATA
+            },
+            "name": metadata["name"] + "-" + new_name_postfix,
+            "labels": {"devenv": new_name_postfix},
+            "annotations": annotations,
+        },
+        "spec": {
+            **spec,
+            "replicas": 1,
+            "selector": {
+                **spec["selector"],
+                "matchLabels": {"devenv": new_name_postfix},
+            },
+            "template": {
+                **template,
+                "metadata": {
+                    **template.get("metadata", {}),
+                    "labels": {"devenv": new_name_postfix},
+                },
+                "spec": deepcopy(template["spec"]),
+            },
+        },
+    }
+
+
+def with_template_copy(manifest):
+    """Shallow copy of `manifest` whose pod template spec can be mutated."""
+    template = manifest["spec"]["template"]
+    return {
+        **manifest,
+        "spec": {
+            **manifest["spec"],
+            "template": {**template, "spec": deepcopy(template["spec"])},
+        },
     }
-    new_manifest["metadata"]["labels"] = {"devenv": new_name_postfix}
-    new_manifest["spec"]["selector"]["matchLabels"] = {"devenv": new_name_postfix}
-    new_manifest["spec"]["replicas"] = 1
-    del new_manifest["status"]
-    return new_manifest
 
 
 def kubectl_delete(namespace: str, name: str, kind: str, logger) -> None:
+    """Delete an object, if it still exists."""
     logger.debug("Will delete %s:\n%s", kind, name)
-    cmd = ["kubectl", "-n", namespace, "delete", kind, name]
-    subprocess.run(cmd, check=True, timeout=5)
+    try:
+        kubeapi.delete(namespace=namespace, kind=kind, name=name)
+    except kubeapi.ApiError as exc:
+        if exc.status != 404:
+            raise
+        logger.debug("%s:%s is already deleted", kind, name)
 
 
-def kubectl_apply(namespace: str, manifest: str | dict | list, logger) -> None:
-    if isinstance(manifest, list):
-        for item in manifest:
-            kubectl_apply(namespace, item, logger)
-        return
+def kubectl_apply(namespace: str, manifest: str | dict | list, logger) -> list[dict]:
+    if isinstance(manifest, str):
+        manifest = list(yaml.load_all(manifest, Loader=manifests.Loader))
     elif isinstance(manifest, dict):
-        manifest = yaml.safe_dump(manifest)
-    logger.debug("Will apply manifest:\n%s", manifest)
-    cmd = ["kubectl", "-n", namespace, "apply", "-f", "-"]
-    subprocess.run(cmd, input=manifest.encode(), check=True, timeout=5)
+        manifest = [manifest]
+    logger.debug("Will apply manifests:\n%s", manifest)
+    return kubeapi.apply_all(namespace=namespace, manifests=manifest)
 
 
 def kubectl_get(namespace: str, kind: str, labels: dict[str, str]) -> list[dict]:
-    labels_str = ",".join(f"{key}={val}" for key, val in labels.items())
-    cmd = ["kubectl", "-n", namespace, "get", kind, "-l", labels_str, "-o", "yaml"]
-    proc = subprocess.run(cmd, capture_output=True, check=True, timeout=5)
-    manifest = yaml.safe_load(proc.stdout)
-    assert manifest.get("kind") == "List"
-    return manifest["items"]
+    return kubeapi.list_(namespace=namespace, kind=kind, labels=labels)
+
 
+def iter_mounts_and_manifests(namespace, mounts, index):
+    """Yield every target workload of `mounts`, along with its mount options.
 
-def iter_mounts_and_manifests(namespace, mounts):
+    Workloads are yielded as stored in the index, they must not be mutated.
+    See `with_template_copy` and `clone_manifest`.
+    """
     for mount in mounts:
         assert isinstance(mount, dict), repr(mount)
         for attr in ("kind", "labels", "mountPath", "mounted", "entrypoints"):
             assert attr in mount, mount
-        if mount["kind"].lower() != "deployment":
-            raise NotImplementedError("Only deployments are supported.")
-        for manifest in kubectl_get(
-            namespace=namespace, kind=mount["kind"], labels=mount["labels"]
+        if mount["kind"].lower() not in ("deployment", "statefulset"):
+            raise NotImplementedError(
+                "Only deployments and statefulsets are supported."
+            )
+        for manifest in find_workloads(
+            index,
+            namespace=namespace,
+            kind=mount["kind"],
+            labels=mount["labels"],
+            copy=False,
         ):
             yield (
                 manifest,
@@ -235,6 +1358,8 @@ def iter_mounts_and_manifests(namespace, mounts):
                 mount["mountPath"],
                 mount.get("subPath", ""),
                 mount["entrypoints"],
+                mount.get("partition"),
+                mount.get("dependenciesPath", ""),
             )
 
 
@@ -245,19 +1370,21 @@ def add_mount(
     pvc_name: str,
     mount_path: str,
     sub_path: str = "",
+    read_only: bool = False,
 ) -> None:
     # Configure volume.
-    volumes = manifest["spec"]["template"]["spec"].get("volumes", [])
+    claim = {"claimName": pvc_name}
+    if read_only:
+        claim["readOnly"] = True
+    volumes = manifest["spec"]["template"]["spec"].setdefault("volumes", [])
     for volume in volumes:
         if volume["name"] == volume_name:
             # Update existing volume.
-            volume["persistentVolumeClaim"]["claimName"] = pvc_name
+            volume["persistentVolumeClaim"] = claim
             break
     else:
         # Add new volume.
-        volumes.append(
-            {"name": volume_name, "persistentVolumeClaim": {"claimName": pvc_name}}
-        )
+        volumes.append({"name": volume_name, "persistentVolumeClaim": claim})
     # Configure volume mount.
     for container in manifest["spec"]["template"]["spec"]["containers"]:
         mounts = container.get("volumeMounts", [])
@@ -269,19 +1396,25 @@ def add_mount(
                     mount["subPath"] = sub_path
                 else:
                     mount.pop("subPath", None)
+                if read_only:
+                    mount["readOnly"] = True
+                else:
+                    mount.pop("readOnly", None)
                 break
         else:
             # Add new volume mount.
             mount = {"name": volume_name, "mountPath": mount_path}
             if sub_path:
                 mount["subPath"] = sub_path
+            if read_only:
+                mount["readOnly"] = True
             mounts.append(mount)
             container["volumeMounts"] = mounts
 
 
 def remove_mount(*, manifest: dict, volume_name: str) -> None:
     # Remove volume.
-    volumes = manifest["spec"]["template"]["spec"]["volumes"]
+    volumes = manifest["spec"]["template"]["spec"].get("volumes", [])
     for i, volume in reversed(list(enumerate(volumes))):
         if volume["name"] == volume_name:
             volumes.pop(i)
@@ -293,6 +1426,106 @@ def remove_mount(*, manifest: dict, volume_name: str) -> None:
                 mounts.pop(i)
 
 
+def add_cache(
+    *,
+    manifest: dict,
+    volume_name: str,
+    pvc_name: str,
+    mount_path: str,
+    sub_path: str,
+    cache: dict,
+    image: str,
+) -> None:
+    """Mount a local mirror of the code volume instead of the volume itself.
+
+    The mirror is an emptyDir, filled by an init container before the pod
+    starts and kept in sync with the volume by a sidecar, so that the code is
+    read from local disk while it's still synced to the shared volume. See
+    `CACHE_SYNC`, which `reload.py` also runs in the sidecar before reloading.
+    """
+    pod_spec = manifest["spec"]["template"]["spec"]
+    cache_name = f"{volume_name}-cache"
+    sync_name = f"{volume_name}-cache-sync"
+    empty_dir = {key: cache[key] for key in ("medium", "sizeLimit") if key in cache}
+    volumes = pod_spec.setdefault("volumes", [])
+    upsert(
+        volumes,
+        {
+            "name": volume_name,
+            "persistentVolumeClaim": {"claimName": pvc_name, "readOnly": True},
+        },
+    )
+    upsert(volumes, {"name": cache_name, "emptyDir": empty_dir})
+    # Replace the code volume with its mirror, keeping the order of mounts.
+    for container in pod_spec["containers"]:
+        if container["name"] == sync_name:
+            continue
+        mounts = [
+            mount
+            for mount in container.get("volumeMounts", [])
+            if mount["name"] != volume_name
+        ]
+        upsert(mounts, {"name": cache_name, "mountPath": mount_path})
+        container["volumeMounts"] = mounts
+    source = {"name": volume_name, "mountPath": CACHE_SOURCE, "readOnly": True}
+    if sub_path:
+        source["subPath"] = sub_path
+    mounts = [source, {"name": cache_name, "mountPath": CACHE_TARGET}]
+    upsert(
+        pod_spec.setdefault("initContainers", []),
+        {
+            "name": f"{volume_name}-cache-init",
+            "image": image,
+            "imagePullPolicy": image_pull_policy(image),
+            "command": ["sh", "-c", CACHE_SYNC],
+            "volumeMounts": mounts,
+            **CONTAINER_DEFAULTS,
+        },
+    )
+    interval = cache["syncInterval"]
+    upsert(
+        pod_spec["containers"],
+        {
+            "name": sync_name,
+            "image": image,
+            "imagePullPolicy": image_pull_policy(image),
+            "command": [
+                "sh",
+                "-c",
+                f"while true; do {CACHE_SYNC}; sleep {interval}; done",
+            ],
+            "volumeMounts": deepcopy(mounts),
+            **CONTAINER_DEFAULTS,
+        },
+    )
+
+
+def remove_cache(*, manifest: dict, volume_name: str) -> None:
+    pod_spec = manifest["spec"]["template"]["spec"]
+    remove_mount(manifest=manifest, volume_name=f"{volume_name}-cache")
+    pod_spec["containers"] = [
+        c for c in pod_spec["containers"] if c["name"] != f"{volume_name}-cache-sync"
+    ]
+    init_containers = [
+        c
+        for c in pod_spec.get("initContainers", [])
+        if c["name"] != f"{volume_name}-cache-init"
+    ]
+    if init_containers:
+        pod_spec["initContainers"] = init_containers
+    else:
+        pod_spec.pop("initContainers", None)
+
+
+def upsert(items: list[dict], item: dict) -> None:
+    """Replace the item with the same name in `items`, or append it."""
+    for i, existing in enumerate(items):
+        if existing["name"] == item["name"]:
+            items[i] = item
+            return
+    items.append(item)
+
+
 def update_entrypoints(*, manifest: dict, entrypoints: dict) -> None:
     for container in manifest["spec"]["template"]["spec"]["containers"]:
         entrypoint = entrypoints.get(container["name"])
@@ -311,3 +1544,101 @@ def restore_entrypoints(*, manifest: dict, entrypoints: dict) -> None:
         if container.get("command"):
             del container["command"]
             del container["args"]
+
+
+def labels_of(manifest: dict) -> dict[str, str]:
+    return manifest["metadata"].get("labels", {})
+
+
+def update_debug(*, manifest: dict, debug: dict) -> None:
+    """Make a container of the workload idle, to run its entrypoint by hand.
+
+    The entrypoint and probes of the debugged container are saved in an
+    annotation, so that `debug.py` can run the entrypoint interactively and
+    `restore_debug` can restore them. Probes are dropped, since the idle
+    container would fail them.
+    """
+    containers = manifest["spec"]["template"]["spec"]["containers"]
+    container = next(
+        (c for c in containers if c["name"] == debug.get("container")), containers[0]
+    )
+    original = {"container": container["name"], "labels": debug["labels"]}
+    for key in DEBUG_FIELDS:
+        if key in container:
+            original[key] = container.pop(key)
+    container["command"] = debug.get("command", ["sleep", "infinity"])
+    manifest["metadata"] = {
+        **manifest["metadata"],
+        "annotations": {
+            **manifest["metadata"].get("annotations", {}),
+            DEBUG_ORIGINAL: json.dumps(original, sort_keys=True),
+        },
+    }
+
+
+def restore_debug(*, manifest: dict) -> None:
+    annotations = manifest["metadata"].get("annotations", {})
+    if DEBUG_ORIGINAL not in annotations:
+        return
+    original = json.loads(annotations[DEBUG_ORIGINAL])
+    for container in manifest["spec"]["template"]["spec"]["containers"]:
+        if container["name"] == original["container"]:
+            for key in DEBUG_FIELDS:
+                container.pop(key, None)
+                if key in original:
+                    container[key] = original[key]
+    manifest["metadata"] = {
+        **manifest["metadata"],
+        "annotations": {
+            key: val for key, val in annotations.items() if key != DEBUG_ORIGINAL
+        },
+    }
+
+
+def update_partition(*, manifest: dict, partition: int | None) -> None:
+    """Only roll a StatefulSet out to the pods from ordinal `partition` up.
+
+    The partition it had before is saved in an annotation, so that it can be
+    restored on unmount. If `partition` is None, it is restored right away.
+    """
+    if manifest["kind"] != "StatefulSet":
+        return
+    if partition is None:
+        restore_partition(manifest=manifest)
+        return
+    strategy = manifest["spec"].get("updateStrategy", {})
+    if strategy.get("type", "RollingUpdate") != "RollingUpdate":
+        return
+    rolling_update = strategy.get("rollingUpdate", {})
+    annotations = manifest["metadata"].get("annotations", {})
+    if ORIGINAL_PARTITION not in annotations:
+        original = str(rolling_update.get("partition", 0))
+        manifest["metadata"] = {
+            **manifest["metadata"],
+            "annotations": {**annotations, ORIGINAL_PARTITION: original},
+        }
+    manifest["spec"]["updateStrategy"] = {
+        **strategy,
+        "type": "RollingUpdate",
+        "rollingUpdate": {**rolling_update, "partition": partition},
+    }
+
+
+def restore_partition(*, manifest: dict) -> None:
+    annotations = manifest["metadata"].get("annotations", {})
+    if ORIGINAL_PARTITION not in annotations:
+        return
+    manifest["metadata"] = {
+        **manifest["metadata"],
+        "annotations": {
+            key: val for key, val in annotations.items() if key != ORIGINAL_PARTITION
+        },
+    }
+    strategy = manifest["spec"].get("updateStrategy", {})
+    manifest["spec"]["updateStrategy"] = {
+        **strategy,
+        "rollingUpdate": {
+            **strategy.get("rollingUpdate", {}),
+            "partition": int(annotations[ORIGINAL_PARTITION]),
+        },
+    }